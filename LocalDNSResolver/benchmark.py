@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the local DNS resolver, without network
+
+- packet:  queries per second answered from the cache, by encoding a response from the RRsets cached
+           against replaying the response cached encoded
+- parse:   messages per second parsed eagerly against lazily, from a corpus of responses captured or
+           from typical ones made up
+- compression: bytes saved by compressing names, over such a corpus
+- capture: responses of a DNS server to queries of several types for some names, as a corpus for parse
+- load:    queries per second answered by resolvers of more and more worker processes, under the load of
+           client processes, with a made-up upstream server
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+from dns_msg import LazyMessage, Message
+from dns_resolver import DNSResolver, serve_workers
+from time import perf_counter
+from typing import List
+
+
+def rate(func, count: int) -> float:
+    """Calls of func per second"""
+    start_time = perf_counter()
+    for _ in range(count):
+        func()
+    return count / (perf_counter() - start_time)
+
+
+def make_query(labels: list, q_type: int = Message.QType.A.value, txid: int = 0) -> bytes:
+    query = Message()
+    query.header['id'] = txid
+    query.header['rd'] = True
+    query.questions = [Message.Question(labels, q_type, Message.QClass.IN.value)]
+    return query.encode()
+
+
+def make_response(labels: list, addresses: int, ttl: int = 300) -> bytes:
+    """A response to a query of the A records of a name, aliased to another one with `addresses` A records"""
+    target = ['target'] + labels[1:]
+    resp = Message()
+    resp.header['qr'] = Message.MsgType.Response
+    resp.header['rd'] = resp.header['ra'] = True
+    resp.questions = [Message.Question(labels, Message.QType.A.value, Message.QClass.IN.value)]
+    expiration = time.time() + ttl
+    alias = Message.dump_name(target)
+    resp.answers = [Message.ResRecord(labels, Message.QType.CNAME.value, Message.QClass.IN.value, expiration,
+                                      len(alias), alias)]
+    resp.answers.extend(Message.ResRecord(target, Message.QType.A.value, Message.QClass.IN.value, expiration, 4,
+                                          struct.pack('!4B', 10, 0, i >> 8 & 0xff, i & 0xff))
+                        for i in range(addresses))
+    return resp.encode()
+
+
+def packet(args):
+    labels = ['www', 'example', 'com']
+    resolver = DNSResolver('127.0.0.1')
+    resolver.update_cache(Message.parse(make_response(labels, args.answers)))
+    queries = [make_query(labels, txid=i) for i in range(256)]
+
+    def encode_answer(query_data: bytes) -> bytes:
+        resp, _ = resolver.cached_response(Message.parse(query_data), time.time())
+        return resp.encode()
+
+    def replay_answer(query_data: bytes) -> bytes:
+        return resolver.packets.get(query_data)
+
+    resp, _ = resolver.cached_response(Message.parse(queries[0]), time.time())
+    encoded, ttl_offsets = resp.encode_with_ttl_offsets()
+    resolver.packets.set(resolver.packets.key(queries[0]), encoded, ttl_offsets, time.time() + 300)
+    for query_data in queries:
+        replayed, expected = replay_answer(query_data), bytearray(encode_answer(query_data))
+        for offset in ttl_offsets:  # which may be a second apart
+            replayed[offset:offset+4] = expected[offset:offset+4] = bytes(4)
+        assert replayed == expected, 'replayed response differs'
+
+    print('Answers from the cache of 1 CNAME and {} A records, {} bytes, {} queries'.format(
+        args.answers, len(encoded), args.count))
+    for name, answer in (('encode', encode_answer), ('replay', replay_answer)):
+        queries_iter = iter(queries * (args.count // len(queries) + 1))
+        print('{:>8}: {:10.0f} queries/s'.format(name, rate(lambda: answer(next(queries_iter)), args.count)))
+
+
+def made_up_corpus() -> List[bytes]:
+    """Responses shaped like typical ones: aliases, several addresses, referrals and glue, mail exchanges,
+    negative answers"""
+    expiration = time.time() + 300
+    a, aaaa, cname, ns, mx, soa, txt = (t.value for t in (
+        Message.QType.A, Message.QType.AAAA, Message.QType.CNAME, Message.QType.NS, Message.QType.MX,
+        Message.QType.SOA, Message.QType.TXT))
+
+    def rr(name: str, r_type: int, r_data: bytes) -> Message.ResRecord:
+        return Message.ResRecord(name.split('.'), r_type, 1, expiration, len(r_data), r_data)
+
+    def response(name: str, q_type: int, answers=(), authority=(), additional=(), r_code=0) -> bytes:
+        resp = Message()
+        resp.header['qr'] = Message.MsgType.Response
+        resp.header['rd'] = resp.header['ra'] = True
+        resp.header['r_code'] = r_code
+        resp.questions = [Message.Question(name.split('.'), q_type, 1)]
+        resp.answers, resp.authority, resp.additional = list(answers), list(authority), list(additional)
+        return resp.encode()
+
+    def dname(name: str) -> bytes:
+        return Message.dump_name(name.split('.'))
+
+    servers = ['ns{}.example-dns.net'.format(i) for i in range(1, 5)]
+    return [
+        response('www.example.com', a, [rr('www.example.com', cname, dname('www.example.com.cdn.example.net')),
+                                        rr('www.example.com.cdn.example.net', cname, dname('e1.cdn.example.net'))] +
+                 [rr('e1.cdn.example.net', a, bytes([93, 184, 216, i])) for i in range(4)],
+                 [rr('cdn.example.net', ns, dname(server)) for server in servers],
+                 [rr(server, a, bytes([198, 51, 100, i])) for i, server in enumerate(servers)]),
+        response('www.google.com', aaaa, [rr('www.google.com', aaaa, bytes(range(16)))]),
+        response('gmail.com', mx, [rr('gmail.com', mx, struct.pack('!H', 5 * i) + dname(
+            'alt{}.gmail-smtp-in.l.google.com'.format(i))) for i in range(5)],
+                 additional=[rr('alt{}.gmail-smtp-in.l.google.com'.format(i), a, bytes([142, 250, 0, i]))
+                             for i in range(5)]),
+        response('nonexistent.example.org', a, authority=[rr('example.org', soa, dname(
+            'sns.dns.icann.org') + dname('noc.dns.icann.org') + struct.pack('!5I', 2024, 7200, 3600, 1209600, 3600))],
+                 r_code=3),
+        response('example.com', txt, [rr('example.com', txt, bytes([len(text)]) + text) for text in (
+            b'v=spf1 -all', b'wgyf8z8cgvm2qmxpnbnldrcltvk4xqfn', b'x' * 200)]),
+        response('example.org', ns, [rr('example.org', ns, dname(server)) for server in servers],
+                 additional=[rr(server, a, bytes([192, 0, 2, i])) for i, server in enumerate(servers)]),
+    ]
+
+
+def load_corpus(args) -> tuple:
+    """The corpus of messages to benchmark with, and where it is from"""
+    if args.corpus:
+        with open(args.corpus) as f:
+            return [bytes.fromhex(line) for line in f if line.strip()], args.corpus
+    return made_up_corpus(), 'made-up responses'
+
+
+def parse(args):
+    corpus, source = load_corpus(args)
+    for data in corpus:  # same results either way
+        eager, lazy = Message.parse(data), LazyMessage(data)
+        assert eager.header == lazy.header and eager.questions == lazy.questions
+        for section in ('answers', 'authority', 'additional'):
+            assert [rr[:3] + rr[4:] for rr in getattr(eager, section)] == \
+                   [rr[:3] + rr[4:] for rr in getattr(lazy, section)]
+    rounds = max(args.count // len(corpus), 1)
+
+    def parse_eager():
+        for data in corpus:
+            Message.parse(data)
+
+    def parse_question():  # what forwarding needs
+        for data in corpus:
+            message = LazyMessage(data)
+            message.header
+            message.questions
+
+    def parse_lazy():
+        for data in corpus:
+            message = LazyMessage(data)
+            message.header
+            message.questions
+            message.answers
+            message.authority
+            message.additional
+
+    print('{} messages of {} bytes on average from {}, {} rounds'.format(
+        len(corpus), sum(map(len, corpus)) // len(corpus), source, rounds))
+    for name, func in (('eager', parse_eager), ('lazy, question only', parse_question),
+                       ('lazy, all sections', parse_lazy)):
+        print('{:>20}: {:10.0f} messages/s'.format(name, rate(func, rounds) * len(corpus)))
+
+
+def compression(args):
+    corpus, source = load_corpus(args)
+    print('{} messages from {}'.format(len(corpus), source))
+    print('{:>40} {:>5} {:>12} {:>10} {:>6}'.format('question', 'type', 'uncompressed', 'compressed', 'saved'))
+    total_plain = total_compressed = 0
+    over_limit = [0, 0]
+    for data in corpus:
+        lazy = LazyMessage(data)
+        message = Message()
+        message.header = dict(lazy.header)
+        message.questions, message.answers = lazy.questions, lazy.answers
+        message.authority, message.additional = lazy.authority, lazy.additional
+        plain, compressed = message.encode(compress=False), message.encode()
+        assert [rr.r_data for rr in LazyMessage(compressed).answers] == [rr.r_data for rr in message.answers]
+        total_plain += len(plain)
+        total_compressed += len(compressed)
+        over_limit[0] += len(plain) > 512
+        over_limit[1] += len(compressed) > 512
+        question = message.questions[0] if message.questions else None
+        print('{:>40} {:>5} {:>12} {:>10} {:>5.0f}%'.format(
+            '.'.join(question.name) if question else '-', question.q_type if question else '-', len(plain),
+            len(compressed), 100 * (1 - len(compressed) / len(plain))))
+    print('average bytes saved: {:.1f} of {:.1f} ({:.0f}%), messages over 512 bytes: {} uncompressed, {} compressed'
+          .format((total_plain - total_compressed) / len(corpus), total_plain / len(corpus),
+                  100 * (1 - total_compressed / total_plain), *over_limit))
+
+
+def capture(args):
+    types = [Message.QType[name].value for name in args.types]
+    with open(args.output, 'w') if args.output != '-' else sys.stdout as out:
+        for name in args.names:
+            for q_type in types:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.settimeout(args.timeout)
+                    sock.sendto(make_query(name.rstrip('.').split('.'), q_type), (args.server, 53))
+                    try:
+                        print(sock.recv(4096).hex(), file=out)
+                    except socket.timeout:
+                        print('no response for {} {}'.format(name, Message.QType(q_type).name), file=sys.stderr)
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    """Upstream server answering every query with an A record, counting them"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        with self.counter.get_lock():
+            self.counter.value += 1
+        query = LazyMessage(data)
+        question = query.questions[0]
+        resp = Message()
+        resp.header['id'] = query.id
+        resp.header['qr'] = Message.MsgType.Response
+        resp.header['rd'] = resp.header['ra'] = True
+        resp.questions = query.questions
+        resp.answers = [Message.ResRecord(question.name, question.q_type, question.q_class, time.time() + 300, 4,
+                                          bytes([10, 0, 0, 1]))]
+        self.transport.sendto(resp.encode(), addr)
+
+
+def serve_upstream(port: int, counter):
+    async def serve():
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: FakeUpstream(counter), local_addr=('127.0.0.1', port))
+        await loop.create_future()
+    asyncio.run(serve())
+
+
+def load_client(port: int, queries: List[bytes], window: int, duration: float, results, sockets: int = 8):
+    """
+    Keep `window` queries in flight for `duration` seconds, those unanswered for a while taken as lost
+
+    The queries are sent from several sockets, for the kernel to spread them over the workers by source port.
+    """
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(sockets)]
+    for sock in socks:
+        sock.connect(('127.0.0.1', port))
+        sock.setblocking(False)
+    in_flight = dict.fromkeys(socks, 0)
+    last_reply = dict.fromkeys(socks, time.time())
+    replies = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for sock in socks:
+            while in_flight[sock] < max(window // sockets, 1):
+                sock.send(random.choice(queries))
+                in_flight[sock] += 1
+        now = time.time()
+        for sock in select.select(socks, [], [], 0.2)[0]:
+            try:
+                while True:
+                    sock.recv(4096)
+                    replies += 1
+                    in_flight[sock] -= 1
+                    last_reply[sock] = now
+            except BlockingIOError:
+                pass
+        for sock in socks:
+            if now - last_reply[sock] > 0.2:
+                in_flight[sock] = 0  # lost
+                last_reply[sock] = now
+    for sock in socks:
+        sock.close()
+    results.put(replies)
+
+
+def load(args):
+    names = [['host{}'.format(i), 'example', 'com'] for i in range(args.names)]
+    queries = [make_query(name, txid=i) for i, name in enumerate(names)]
+    upstream_queries = multiprocessing.Value('L', 0)
+    upstream = multiprocessing.Process(target=serve_upstream, args=(args.port + 1, upstream_queries), daemon=True)
+    upstream.start()
+    print('{} names, {} client processes keeping {} queries in flight each, {} s a run, {} CPUs'.format(
+        args.names, args.clients, args.window, args.duration, multiprocessing.cpu_count()))
+    print('{:>7} {:>10} {:>17}'.format('workers', 'queries/s', 'upstream queries'))
+    for workers in args.workers:
+        upstream_queries.value = 0
+        resolver = multiprocessing.Process(target=serve_workers, args=(workers,), kwargs=dict(
+            upstream_host='127.0.0.1', upstream_port=args.port + 1, hostname='127.0.0.1', serving_port=args.port))
+        resolver.start()
+        try:
+            time.sleep(.5)
+            results = multiprocessing.Queue()
+            load_client(args.port, queries, args.window, 1, results)  # to warm the caches up
+            results.get()
+            clients = [multiprocessing.Process(target=load_client, args=(
+                args.port, queries, args.window, args.duration, results)) for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            replies = sum(results.get() for _ in clients)
+            for client in clients:
+                client.join()
+        finally:
+            resolver.terminate()
+            resolver.join()
+        print('{:>7} {:>10.0f} {:>17}'.format(workers, replies / args.duration, upstream_queries.value))
+    upstream.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    packet_parser = subparsers.add_parser('packet', help='encoding responses against replaying them (default)')
+    packet_parser.add_argument('-n', '--count', type=int, default=100000, help='number of queries to answer')
+    packet_parser.add_argument('--answers', type=int, default=4, help='number of A records of the name')
+
+    parse_parser = subparsers.add_parser('parse', help='eager parsing against lazy parsing')
+    parse_parser.add_argument('-n', '--count', type=int, default=100000, help='number of messages to parse')
+    parse_parser.add_argument('--corpus', help='file of messages in hex, one a line, as written by capture')
+
+    compression_parser = subparsers.add_parser('compression', help='sizes of messages with names compressed')
+    compression_parser.add_argument('--corpus', help='file of messages in hex, one a line, as written by capture')
+
+    capture_parser = subparsers.add_parser('capture', help='capture responses as a corpus')
+    capture_parser.add_argument('names', nargs='+')
+    capture_parser.add_argument('--server', default='8.8.8.8', help='address of the DNS server to query')
+    capture_parser.add_argument('--types', nargs='+', default=['A', 'AAAA', 'MX', 'NS', 'TXT'])
+    capture_parser.add_argument('--timeout', type=float, default=2)
+    capture_parser.add_argument('-o', '--output', default='-', help='file to write the corpus to')
+
+    load_parser = subparsers.add_parser('load', help='queries per second against the number of worker processes')
+    load_parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4])
+    load_parser.add_argument('-c', '--clients', type=int, default=multiprocessing.cpu_count(),
+                             help='number of client processes')
+    load_parser.add_argument('--names', type=int, default=1000, help='number of names queried')
+    load_parser.add_argument('--window', type=int, default=32, help='queries in flight of each client')
+    load_parser.add_argument('--duration', type=float, default=5, help='seconds of each run')
+    load_parser.add_argument('-p', '--port', type=int, default=15353,
+                             help='port to serve, that after for the upstream server')
+
+    args = parser.parse_args()
+    if args.command == 'parse':
+        parse(args)
+    elif args.command == 'compression':
+        compression(args)
+    elif args.command == 'capture':
+        capture(args)
+    elif args.command == 'load':
+        load(args)
+    else:
+        if args.command is None:
+            args = parser.parse_args(['packet'])
+        packet(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import math
+import mmap
+import multiprocessing
+import struct
+import time
+import zlib
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+
+class TTLCache:
+    """
+    Cache of values that expire, bounded in entries and bytes by evicting the least recently used ones
+
+    Expired entries are swept with a timer wheel of one-second slots, as time goes by on every operation,
+    so that lookups and inserts take amortized O(1) time whatever the number of entries.
+    """
+
+    ENTRY_OVERHEAD = 200  # rough bytes taken by the bookkeeping of an entry, on top of the size of its value
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, expiration, size), least recently used first
+        self._wheel = {}  # type: Dict[int, Set[Hashable]]  # keys by the second they expire in
+        self._swept = None  # type: Optional[int]  # the seconds before are swept
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a key has a value not expired, without counting as a lookup or a use of it"""
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] >= time.time()
+
+    def get(self, key: Hashable, now: Optional[float] = None) -> Any:
+        """Look up the value of a key, or None if it is absent or expired"""
+        now = time.time() if now is None else now
+        self.sweep(now)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < now:
+            if entry is not None:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, expiration: float, size: int = 0, now: Optional[float] = None):
+        """
+        Add or replace the value of a key, until the expiration time (in seconds since the epoch)
+
+        :param size: bytes taken by the value, counted against max_bytes
+        """
+        now = time.time() if now is None else now
+        self.sweep(now)
+        if key in self._entries:
+            self._remove(key)
+        size += TTLCache.ENTRY_OVERHEAD
+        if expiration < now or size > self.max_bytes:
+            return
+        self._entries[key] = value, expiration, size
+        self._wheel.setdefault(math.floor(expiration), set()).add(key)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def sweep(self, now: Optional[float] = None):
+        """Remove the entries expired in the seconds gone by since the last sweep"""
+        current = math.floor(time.time() if now is None else now)
+        if self._swept is None or current < self._swept:
+            self._swept = current
+            return
+        if current - self._swept > len(self._wheel):  # quicker to go through the slots than the seconds
+            seconds = [second for second in self._wheel if second < current]
+        else:
+            seconds = range(self._swept, current)
+        for second in seconds:
+            for key in self._wheel.pop(second, ()):
+                _, _, size = self._entries.pop(key)
+                self.bytes -= size
+                self.expirations += 1
+        self._swept = current
+
+    def clear(self):
+        self._entries.clear()
+        self._wheel.clear()
+        self.bytes = 0
+
+    def as_dict(self) -> dict:
+        return dict(entries=len(self._entries), bytes=self.bytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations)
+
+    def _remove(self, key: Hashable):
+        _, expiration, size = self._entries.pop(key)
+        self.bytes -= size
+        second = math.floor(expiration)
+        keys = self._wheel[second]
+        keys.discard(key)
+        if not keys:
+            del self._wheel[second]
+
+
+class PacketCache:
+    """
+    Cache of encoded responses by the question they answer, replayed with the ID of each query and the TTLs
+    counted down patched in, with neither parsing nor encoding
+
+    Only standard queries of one question are answered, their name uncompressed as ever in practice.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 << 20):
+        self.entries = TTLCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    @staticmethod
+    def key(query: bytes) -> Optional[bytes]:
+        """The question of a query, with its name in lower case, or None if the query is not one to answer"""
+        if len(query) < 17 or query[2] & 0xf8 or query[4:6] != b'\x00\x01':  # QR, opcode, QDCOUNT
+            return None
+        idx = 12
+        try:
+            while query[idx]:
+                if query[idx] & 0xc0:  # compressed
+                    return None
+                idx += query[idx] + 1
+        except IndexError:
+            return None
+        if idx + 5 > len(query):
+            return None
+        # label lengths are below 64, so that only the letters of the labels are lowered
+        return query[12:idx].lower() + query[idx:idx+5]
+
+    def get(self, query: bytes, key: Optional[bytes] = None, now: Optional[float] = None) -> Optional[bytearray]:
+        """The response cached to a query, patched to answer it, or None"""
+        key = PacketCache.key(query) if key is None else key
+        if key is None:
+            return None
+        now = time.time() if now is None else now
+        entry = self.entries.get(key, now)
+        if entry is None:
+            return None
+        data, ttls, stored = entry
+        response = bytearray(data)
+        response[0:2] = query[0:2]  # ID
+        response[2] = response[2] & 0xfe | query[2] & 0x01  # RD
+        response[12:12+len(key)-4] = query[12:12+len(key)-4]  # name, in the case of the query
+        elapsed = int(now - stored)
+        for offset, ttl in ttls:
+            struct.pack_into('!I', response, offset, ttl - elapsed if ttl > elapsed else 0)
+        return response
+
+    def set(self, key: bytes, response: bytes, ttl_offsets: List[int], expiration: float,
+            now: Optional[float] = None):
+        """
+        Cache a response encoded, until the expiration time at the latest
+
+        :param ttl_offsets: where the TTL fields of its records are in the response
+        """
+        now = time.time() if now is None else now
+        ttls = tuple((offset, struct.unpack_from('!I', response, offset)[0]) for offset in ttl_offsets)
+        self.entries.set(key, (bytes(response), ttls, now), expiration, len(response) + 16 * len(ttls), now)
+
+
+class SharedCache:
+    """
+    Cache of values in bytes shared by the processes forked after it is made, in an anonymous shared mmap
+
+    The mmap is a hash table of fixed-size slots, in sets of WAYS slots a key may be in. A value replaces the one
+    of the same key in the set, else an expired one, else the one expiring first. Writers take one of a few locks,
+    striped across the sets. Readers take none: every slot has a sequence number, odd while the slot is written,
+    and a checksum, so that a value read while it was being replaced is missed rather than returned torn.
+    Values longer than a slot holds are not cached.
+    """
+
+    WAYS = 4
+    LOCKS = 64
+    # sequence number, CRC-32 of the rest, expiration, when stored, length of the key, length of the value
+    SLOT_HEADER = struct.Struct('=IIddHH')
+
+    def __init__(self, slots: int = 16384, slot_size: int = 1024):
+        self.sets = max(slots // SharedCache.WAYS, 1)
+        self.slot_size = slot_size
+        self.hits = 0
+        self.misses = 0
+        self._map = mmap.mmap(-1, self.sets * SharedCache.WAYS * slot_size)  # shared with the processes forked
+        context = multiprocessing.get_context('fork')
+        self._locks = [context.Lock() for _ in range(min(SharedCache.LOCKS, self.sets))]
+
+    def get(self, key: bytes, now: Optional[float] = None) -> Optional[Tuple[bytes, float]]:
+        """The value of a key not expired and when it was stored, or None"""
+        now = time.time() if now is None else now
+        for slot in self._slots(key):
+            entry = self._read(slot)
+            if entry is not None and entry[0] == key and entry[2] >= now:
+                self.hits += 1
+                return entry[1], entry[3]
+        self.misses += 1
+        return None
+
+    def set(self, key: bytes, value: bytes, expiration: float, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        header = SharedCache.SLOT_HEADER
+        if header.size + len(key) + len(value) > self.slot_size:
+            return
+        slots = self._slots(key)
+        with self._locks[slots[0] // self.slot_size // SharedCache.WAYS % len(self._locks)]:
+            slot = min(slots, key=lambda slot: self._rank(slot, key, now))
+            sequence, = struct.unpack_from('=I', self._map, slot)
+            struct.pack_into('=I', self._map, slot, sequence + 1)  # odd: being written
+            start = slot + header.size
+            self._map[start:start+len(key)+len(value)] = key + value
+            crc = zlib.crc32(struct.pack('=ddHH', expiration, now, len(key), len(value)) + key + value)
+            header.pack_into(self._map, slot, sequence + 1, crc, expiration, now, len(key), len(value))
+            struct.pack_into('=I', self._map, slot, sequence + 2)
+
+    def as_dict(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+    def _slots(self, key: bytes) -> list:
+        first = zlib.crc32(key) % self.sets * SharedCache.WAYS
+        return [(first + i) * self.slot_size for i in range(SharedCache.WAYS)]
+
+    def _rank(self, slot: int, key: bytes, now: float) -> tuple:
+        """Order of the slots to write a key in: that of the same key first, then those expired, then the sooner"""
+        header = SharedCache.SLOT_HEADER
+        _, _, expiration, _, key_length, _ = header.unpack_from(self._map, slot)
+        start = slot + header.size
+        return self._map[start:start+key_length] != key, expiration >= now, expiration
+
+    def _read(self, slot: int) -> Optional[tuple]:
+        header = SharedCache.SLOT_HEADER
+        sequence, crc, expiration, stored, key_length, value_length = header.unpack_from(self._map, slot)
+        if sequence & 1 or key_length + value_length + header.size > self.slot_size:
+            return None
+        start = slot + header.size
+        content = self._map[start:start+key_length+value_length]
+        if struct.unpack_from('=I', self._map, slot)[0] != sequence or sequence == 0 or zlib.crc32(
+                struct.pack('=ddHH', expiration, stored, key_length, value_length) + content) != crc:
+            return None  # being written, never written, or written over meanwhile
+        return content[:key_length], content[key_length:], expiration, stored
@@ -1,11 +1,13 @@
 # TODO: refactor
 
+import itertools
 import math
 import struct
 import time
 
 from collections import namedtuple
 from enum import Enum
+from typing import Optional
 
 
 class Message:
@@ -42,16 +44,21 @@ class Message:
         CH = 3
         HS = 4
 
+    # types whose RDATA is a domain name
+    NAME_TYPES = frozenset(t.value for t in (QType.CNAME, QType.NS, QType.PTR, QType.MD, QType.MF, QType.MB,
+                                             QType.MG, QType.MR))
+
 
     class Question(namedtuple('Question', ['name', 'q_type', 'q_class'])):
         @property
         def cache_key(self):
-            return '{}#{}#{}'.format('.'.join(self.name), self.q_type, self.q_class)
+            # names compared case-insensitively (RFC 1035 2.3.3)
+            return '.'.join(self.name).lower(), self.q_type, self.q_class
 
     class ResRecord(namedtuple('ResRecord', ['name', 'r_type', 'r_class', 'expiration', 'r_length', 'r_data'])):
         @property
         def cache_key(self):
-            return '{}#{}#{}'.format('.'.join(self.name), self.r_type, self.r_class)
+            return '.'.join(self.name).lower(), self.r_type, self.r_class
 
     def __init__(self):
         self.header = dict(
@@ -111,18 +118,60 @@ class Message:
         except IndexError as e:
             raise ValueError from e
 
-    def encode(self) -> bytes:
-        """Pack a DNS message into bytes that can be transferred"""
+    def encode(self, compress: bool = True) -> bytes:
+        """Pack a DNS message into bytes that can be transferred, with names compressed unless told not to"""
+        return self.encode_with_ttl_offsets(compress)[0]
+
+    def encode_with_ttl_offsets(self, compress: bool = True) -> tuple:
+        """
+        Pack a DNS message into bytes, also finding where the TTLs of the records are in them
+
+        :return: the message encoded, and the offsets of the TTL fields of all its records
+        """
         self.header['qd_count'] = len(self.questions)
         self.header['an_count'] = len(self.answers)
         self.header['ns_count'] = len(self.authority)
         self.header['ar_count'] = len(self.additional)
-        encoded = [Message.dump_header(self.header)]
-        encoded.extend((Message.dump_question(q) for q in self.questions))
-        encoded.extend((Message.dump_rr(ans) for ans in self.answers))
-        encoded.extend((Message.dump_rr(auth) for auth in self.authority))
-        encoded.extend((Message.dump_rr(addi) for addi in self.additional))
-        return b''.join(encoded)
+        names = {} if compress else None  # suffixes of the names written -> where they are
+        encoded = bytearray(Message.dump_header(self.header))
+        for q in self.questions:
+            encoded += Message.dump_name(q.name, len(encoded), names)
+            encoded += struct.pack('!2H', q.q_type, q.q_class)
+        now = time.time()
+        ttl_offsets = []
+        for rr in itertools.chain(self.answers, self.authority, self.additional):
+            encoded += Message.dump_name(rr.name, len(encoded), names)
+            ttl = math.floor(rr.expiration - now)
+            ttl_offsets.append(len(encoded) + 4)
+            r_data = Message.dump_rdata(rr, len(encoded) + 10, names)
+            encoded += struct.pack('!2H1I1H', rr.r_type, rr.r_class, ttl if ttl >= 0 else 0, len(r_data))
+            encoded += r_data
+        return bytes(encoded), ttl_offsets
+
+    @staticmethod
+    def server_failure(query: 'Message') -> 'Message':
+        """Make a SERVFAIL response (RFC 1035 4.1.1) to a query, for when no answer can be got"""
+        resp = Message()
+        resp.header['id'] = query.header['id']
+        resp.header['qr'] = Message.MsgType.Response
+        resp.header['op_code'] = query.header['op_code']
+        resp.header['rd'] = query.header['rd']
+        resp.header['r_code'] = 2
+        resp.questions = query.questions
+        return resp
+
+    @staticmethod
+    def format_error(query_data: bytes) -> Optional['Message']:
+        """Make a FORMERR response (RFC 1035 4.1.1) to a query that cannot be parsed, or None if it has no ID"""
+        if len(query_data) < 4:
+            return None
+        resp = Message()
+        resp.header['id'] = query_data[0] << 8 | query_data[1]
+        resp.header['qr'] = Message.MsgType.Response
+        resp.header['op_code'] = (query_data[2] & 0x78) >> 3
+        resp.header['rd'] = query_data[2] & 0x01 != 0
+        resp.header['r_code'] = 1
+        return resp
 
     @staticmethod
     def parse_header(header_data: bytes):
@@ -179,7 +228,7 @@ class Message:
         if header['rd']:
             flags |= 0x0100
         if header['ra']:
-            flags |= 0x0800
+            flags |= 0x0080
         flags |= (header['z'] & 0x7) << 4
         flags |= header['r_code'] & 0xf
         return struct.pack('!6H', header['id'], flags,
@@ -213,16 +262,53 @@ class Message:
         return name, rightmost + 1
 
     @staticmethod
-    def dump_name(nodes: list) -> bytes:
-        """Convert a list of name nodes into bytes using RFC 1035 QNAME representation"""
+    def dump_name(nodes: list, offset: int = 0, names: dict = None) -> bytes:
+        """
+        Convert a list of name nodes into bytes using RFC 1035 QNAME representation
+
+        :param offset: where the name is to be written in the message
+        :param names: suffixes of the names written before in the message -> where they are, to compress this one
+                      with a pointer to the longest one it ends with (RFC 1035 4.1.4), the suffixes of this one added
+        """
         name = []
-        for node in nodes:
+        lowered = tuple(node.lower() for node in nodes) if names is not None else None
+        for i, node in enumerate(nodes):
+            if names is not None:
+                suffix = lowered[i:]
+                pointer = names.get(suffix)
+                if pointer is not None:
+                    name.append(struct.pack('!H', 0xc000 | pointer))
+                    return b''.join(name)
+                if offset < 0x4000:  # beyond, out of reach of pointers
+                    names[suffix] = offset
             node_encoded = node.encode()
             name.append(struct.pack('!B', len(node_encoded)))
             name.append(node_encoded)
+            offset += len(node_encoded) + 1
         name.append(struct.pack('B', 0))
         return b''.join(name)
 
+    @staticmethod
+    def dump_rdata(rr, offset: int = 0, names: dict = None) -> bytes:
+        """
+        RDATA of a record, with the domain names in it compressed with the names written before (see dump_name),
+        for the types defined in RFC 1035 only, as others may not know them (RFC 3597 4)
+        """
+        try:
+            if rr.r_type in Message.NAME_TYPES:
+                return Message.dump_name(Message.parse_name(rr.r_data, 0)[0], offset, names)
+            if rr.r_type == Message.QType.MX.value:  # preference, exchange
+                exchange, _ = Message.parse_name(rr.r_data, 2)
+                return rr.r_data[:2] + Message.dump_name(exchange, offset + 2, names)
+            if rr.r_type == Message.QType.SOA.value:  # mname, rname, then 5 32-bit fields
+                mname, names_end = Message.parse_name(rr.r_data, 0)
+                rname, names_end = Message.parse_name(rr.r_data, names_end)
+                mname = Message.dump_name(mname, offset, names)
+                return mname + Message.dump_name(rname, offset + len(mname), names) + rr.r_data[names_end:]
+        except (ValueError, IndexError):
+            pass  # not as it should be, left as is
+        return rr.r_data
+
     @staticmethod
     def parse_question(data: bytes, offset: int) -> tuple:
         """
@@ -281,8 +367,28 @@ class Message:
         """
         name, new_offset = Message.parse_name(data, offset)
         rr_type, rr_class, ttl, length = struct.unpack('!2H1I1H', data[new_offset:new_offset+10])
-        res_data = data[new_offset+10:new_offset+10+length]
-        return Message.ResRecord(name, rr_type, rr_class, ttl+time.time(), length, res_data), new_offset+10+length
+        res_data = Message.parse_rdata(data, rr_type, new_offset+10, length)
+        return (Message.ResRecord(name, rr_type, rr_class, ttl+time.time(), len(res_data), res_data),
+                new_offset+10+length)
+
+    @staticmethod
+    def parse_rdata(data: bytes, rr_type: int, offset: int, length: int) -> bytes:
+        """
+        Extract the RDATA of a resource record, with the domain names in it decompressed (RFC 1035 3.3),
+        so that it makes sense out of the message it comes from
+        """
+        end = offset + length
+        if end > len(data):
+            raise ValueError('RDATA out of the message')
+        if rr_type in Message.NAME_TYPES:
+            return Message.dump_name(Message.parse_name(data, offset)[0])
+        if rr_type == Message.QType.MX.value:  # preference, exchange
+            return data[offset:offset+2] + Message.dump_name(Message.parse_name(data, offset+2)[0])
+        if rr_type == Message.QType.SOA.value:  # mname, rname, then 5 32-bit fields
+            mname, names_end = Message.parse_name(data, offset)
+            rname, names_end = Message.parse_name(data, names_end)
+            return Message.dump_name(mname) + Message.dump_name(rname) + data[names_end:end]
+        return data[offset:end]
 
     @staticmethod
     def dump_rr(rr) -> bytes:
@@ -291,3 +397,170 @@ class Message:
         return b''.join([Message.dump_name(rr.name),
                          struct.pack('!2H1I1H', rr.r_type, rr.r_class, ttl if ttl >= 0 else 0, rr.r_length),
                          rr.r_data])
+
+
+class LazyMessage:
+    """
+    DNS message decoded lazily from its bytes, for the parts looked at only
+
+    The header is decoded on first access, and the questions, answers, authority and additional records
+    section by section, the sections before being skipped over rather than decoded. Every name is decoded once,
+    however many compression pointers refer to it. Sections are lists of Message.Question and Message.ResRecord
+    as with Message.parse(), with the RDATA of records decompressed likewise.
+    """
+
+    __slots__ = ('data', 'counts', '_header', '_sections', '_section_offsets', '_names')
+
+    def __init__(self, data: bytes):
+        if len(data) < 12:
+            raise ValueError('message shorter than a header')
+        self.data = data if isinstance(data, bytes) else bytes(data)
+        self.counts = struct.unpack_from('!4H', data, 4)  # QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT
+        self._header = None
+        self._sections = [None] * 4
+        self._section_offsets = [12, None, None, None, None]  # where each section starts, then the end
+        self._names = {}  # offset -> labels of the name there, and the offset after it
+
+    @property
+    def id(self) -> int:
+        return self.data[0] << 8 | self.data[1]
+
+    @property
+    def header(self) -> dict:
+        if self._header is None:
+            self._header = Message.parse_header(self.data[:12])
+        return self._header
+
+    @property
+    def questions(self) -> list:
+        return self._section(0)
+
+    @property
+    def answers(self) -> list:
+        return self._section(1)
+
+    @property
+    def authority(self) -> list:
+        return self._section(2)
+
+    @property
+    def additional(self) -> list:
+        return self._section(3)
+
+    @property
+    def questions_end(self) -> int:
+        """Offset of the end of the question section"""
+        return self._section_offset(1)
+
+    def name_at(self, offset: int) -> tuple:
+        """
+        Decode the name at an offset, following compression pointers only to before where the name starts,
+        so that every pointer followed goes further back and loops end
+
+        :return: the labels of the name, and the offset after it
+        """
+        cached = self._names.get(offset)
+        if cached is not None:
+            return cached
+        data = self.data
+        labels = []
+        idx = offset
+        try:
+            while True:
+                length = data[idx]
+                if length == 0:
+                    end = idx + 1
+                    break
+                if length & 0xc0 == 0xc0:
+                    pointer = (length & 0x3f) << 8 | data[idx+1]
+                    if pointer >= offset:
+                        raise ValueError('compression pointer not before the name')
+                    labels.extend(self.name_at(pointer)[0])
+                    end = idx + 2
+                    break
+                if length & 0xc0:
+                    raise ValueError('unknown label type')
+                labels.append(data[idx+1:idx+1+length].decode())
+                idx += length + 1
+        except (IndexError, UnicodeDecodeError) as e:
+            raise ValueError from e
+        if end > len(data) or sum(len(label) + 1 for label in labels) > 255:
+            raise ValueError('name out of the message or too long')
+        self._names[offset] = labels, end
+        return labels, end
+
+    def skip_name(self, offset: int) -> int:
+        """The offset after the name at an offset, without decoding it"""
+        data = self.data
+        try:
+            while True:
+                length = data[offset]
+                if length == 0:
+                    return offset + 1
+                if length & 0xc0:
+                    return offset + 2
+                offset += length + 1
+        except IndexError as e:
+            raise ValueError from e
+
+    def _section_offset(self, section: int) -> int:
+        offset = self._section_offsets[section]
+        if offset is None:
+            offset = self._section_offset(section - 1)
+            if section == 1:
+                for _ in range(self.counts[0]):
+                    offset = self.skip_name(offset) + 4
+            else:
+                for _ in range(self.counts[section - 1]):
+                    offset = self.skip_name(offset) + 10
+                    if offset > len(self.data):
+                        raise ValueError('record out of the message')
+                    offset += self.data[offset-2] << 8 | self.data[offset-1]
+            if offset > len(self.data):
+                raise ValueError('section out of the message')
+            self._section_offsets[section] = offset
+        return offset
+
+    def _section(self, section: int) -> list:
+        entries = self._sections[section]
+        if entries is not None:
+            return entries
+        offset = self._section_offset(section)
+        data = self.data
+        entries = []
+        if section == 0:
+            for _ in range(self.counts[0]):
+                name, offset = self.name_at(offset)
+                if offset + 4 > len(data):
+                    raise ValueError('question out of the message')
+                q_type, q_class = struct.unpack_from('!2H', data, offset)
+                entries.append(Message.Question(list(name), q_type, q_class))
+                offset += 4
+        else:
+            now = time.time()
+            for _ in range(self.counts[section]):
+                name, offset = self.name_at(offset)
+                if offset + 10 > len(data):
+                    raise ValueError('record out of the message')
+                r_type, r_class, ttl, length = struct.unpack_from('!2HIH', data, offset)
+                offset += 10
+                r_data = self._rdata(r_type, offset, length)
+                entries.append(Message.ResRecord(list(name), r_type, r_class, ttl + now, len(r_data), r_data))
+                offset += length
+        self._section_offsets[section + 1] = offset
+        self._sections[section] = entries
+        return entries
+
+    def _rdata(self, r_type: int, offset: int, length: int) -> bytes:
+        end = offset + length
+        if end > len(self.data):
+            raise ValueError('RDATA out of the message')
+        if r_type in Message.NAME_TYPES:
+            return Message.dump_name(self.name_at(offset)[0])
+        if r_type == Message.QType.MX.value:  # preference, exchange
+            return self.data[offset:offset+2] + Message.dump_name(self.name_at(offset + 2)[0])
+        if r_type == Message.QType.SOA.value:  # mname, rname, then 5 32-bit fields
+            mname, names_end = self.name_at(offset)
+            rname, names_end = self.name_at(names_end)
+            return Message.dump_name(mname) + Message.dump_name(rname) + self.data[names_end:end]
+        return self.data[offset:end]
@@ -1,84 +1,406 @@
 #!/usr/bin/env python
 
-# TODO: refactor, eliminating duplicates
-
+import argparse
+import asyncio
+import itertools
 import logging
-import socket as sock
+import math
+import multiprocessing
+import os
+import random
+import signal
+import struct
+import sys
 import time
 
-from dns_msg import Message
-from socketserver import UDPServer, DatagramRequestHandler
+from collections import namedtuple
+from dns_cache import PacketCache, SharedCache, TTLCache
+from dns_msg import LazyMessage, Message
+from typing import Dict, Optional, Tuple
+
+
+class UpstreamClient(asyncio.DatagramProtocol):
+    """
+    Forwards queries to an upstream server through one long-lived UDP socket
+
+    Every query in flight is given a random transaction ID of its own, so that queries from different clients,
+    which may share IDs, are told apart by the replies; the ID of the client is put back in the reply.
+    A query is sent again if no reply comes in `timeout` seconds, up to `retries` times.
+    """
+
+    def __init__(self, timeout: float = 2.0, retries: int = 2):
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None  # type: Optional[asyncio.DatagramTransport]
+        self._pending = {}  # type: Dict[int, asyncio.Future]
+        self._random = random.SystemRandom()  # unpredictable IDs, against spoofed replies
+
+    @classmethod
+    async def connect(cls, address: tuple, **kwargs) -> 'UpstreamClient':
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(lambda: cls(**kwargs), remote_addr=address)
+        return protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 12:
+            return
+        txid, = struct.unpack_from('!H', data)
+        future = self._pending.get(txid)
+        if future is None or future.done():
+            logging.debug('upstream: unexpected reply with ID %d dropped', txid)
+            return
+        future.set_result(data)
+
+    def error_received(self, exc):
+        logging.warning('upstream: %s', exc)
+
+    def connection_lost(self, exc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError('upstream socket closed'))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def query(self, data: bytes) -> bytes:
+        """
+        Forward a query in wire format and wait for the reply
+
+        :raise asyncio.TimeoutError: if no reply comes after all the retries
+        """
+        if len(self._pending) >= 0x10000:
+            raise ConnectionError('too many queries in flight')
+        txid = self._random.getrandbits(16)
+        while txid in self._pending:
+            txid = self._random.getrandbits(16)
+        client_id = data[:2]
+        data = struct.pack('!H', txid) + data[2:]
+        future = asyncio.get_running_loop().create_future()
+        self._pending[txid] = future
+        try:
+            for attempt in range(self.retries + 1):
+                self.transport.sendto(data)
+                try:
+                    # shielded, for replies to earlier attempts to count after a timeout
+                    reply = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                    return client_id + reply[2:]
+                except asyncio.TimeoutError:
+                    logging.info('upstream: query %d timed out, attempt %d', txid, attempt + 1)
+            raise asyncio.TimeoutError
+        finally:
+            del self._pending[txid]
+
+
+RRsetEntry = namedtuple('RRsetEntry', ['records', 'refresh_at'])  # what is cached for an RRset
+
+
+class DNSResolver(asyncio.DatagramProtocol):
+    """
+    Local DNS resolver, forwarding the queries it cannot answer from its cache to an upstream server
+
+    - prefetch: fraction of the TTL of an RRset after which a query answered with it refreshes it in the
+      background, for popular names never to expire (None not to)
+    - serve_stale: whether to answer with RRsets expired for up to stale_ttl seconds while they are being
+      refreshed (RFC 8767), rather than waiting for the upstream server
+    - reuse_port, shared: for one of several worker processes serving the same port (see serve_workers()),
+      looking up the responses got from the upstream server by the others in a SharedCache when missing
+    """
+
+    MAX_CNAME_CHAIN = 8  # CNAMEs followed from a name at most, against loops
+    STALE_ANSWER_TTL = 30  # TTL of the records of stale answers, as recommended by RFC 8767
+
+    def __init__(self, upstream_host, upstream_port=53, hostname='localhost', serving_port=53,
+                 timeout=2.0, retries=2, cache_entries=10000, cache_bytes=16 << 20,
+                 prefetch=0.9, serve_stale=False, stale_ttl=86400, reuse_port=False,
+                 shared: Optional[SharedCache] = None):
+        self.serving_address = hostname, serving_port
+        self.upstream_address = upstream_host, upstream_port
+        self.timeout = timeout
+        self.retries = retries
+        self.prefetch = prefetch
+        self.serve_stale = serve_stale
+        self.stale_ttl = stale_ttl
+        self.reuse_port = reuse_port
+        self.shared = shared
+        self.upstream = None  # type: Optional[UpstreamClient]
+        self.transport = None  # type: Optional[asyncio.DatagramTransport]
+        self.cache = TTLCache(max_entries=cache_entries, max_bytes=cache_bytes)
+        self.packets = PacketCache(max_entries=cache_entries, max_bytes=cache_bytes)  # responses to replay
+        self._in_flight = {}  # type: Dict[tuple, asyncio.Task]  # upstream queries by the keys of their questions
+        self._tasks = set()
+
+    async def start(self):
+        self.upstream = await UpstreamClient.connect(self.upstream_address, timeout=self.timeout,
+                                                     retries=self.retries)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=self.serving_address,
+                                            reuse_port=self.reuse_port or None)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.get_running_loop().create_future()  # until cancelled
+        finally:
+            self.close()
 
+    def close(self):
+        for task in itertools.chain(self._tasks, self._in_flight.values()):
+            task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        if self.upstream is not None:
+            self.upstream.close()
+        logging.info('cache: %s, packet cache: %s', self.cache.as_dict(), self.packets.entries.as_dict())
 
-def send_and_recv_datagram(server_address: tuple, data, buf_size: int = 4096) -> bytes:
-    """Sends a UDP packet to a host and retrieve response from it"""
-    client_sock = sock.socket(sock.AF_INET, sock.SOCK_DGRAM)
-    client_sock.sendto(data, server_address)
-    response, server_address = client_sock.recvfrom((buf_size))
-    client_sock.close()
-    return response
+    def connection_made(self, transport):
+        self.transport = transport
 
+    def datagram_received(self, data: bytes, addr):
+        resp = self.packets.get(data)
+        if resp is not None:  # the hot path, without a task
+            self.transport.sendto(resp, addr)
+            return
+        task = asyncio.ensure_future(self.handle(data, addr))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-class DNSResolver(UDPServer):
-    class QueryHandler(DatagramRequestHandler):
-        def handle(self):
-            query_data = self.rfile.read(self.server.buf_size)
-            query = Message.parse(query_data)
-            logging.info('Got query')
+    async def handle(self, query_data: bytes, client_address: tuple):
+        try:
+            query = LazyMessage(query_data)  # its records never looked at
+            query.header, query.questions
+        except Exception as e:  # whatever the query, for the client to be replied to
+            logging.info('Malformed query: %r', e)
+            resp = Message.format_error(query_data)
+            if resp is not None:
+                self.transport.sendto(resp.encode(), client_address)
+            return
+        logging.info('Got query')
 
-            if query.header['op_code'] != 0:
-                return
+        if query.header['op_code'] != 0:
+            return
 
-            now = time.time()
+        now = time.time()
+        key = tuple(q.cache_key for q in query.questions)
+        resp, refresh_at = self.cached_response(query, now)
+        if resp is None and self.shared is not None and self.load_shared(key, now):
+            resp, refresh_at = self.cached_response(query, now)
+        encoded = None
+
+        if resp is not None:  # use cached records
+            logging.info('cached records used')
+            if now >= refresh_at:
+                logging.info('refreshing cached records in the background')
+                self.forward(key, query_data)
+            else:  # to be replayed until the records are due for a refresh
+                packet_key = PacketCache.key(query_data)
+                if packet_key is not None:
+                    encoded, ttl_offsets = resp.encode_with_ttl_offsets()
+                    expiration = min((rr.expiration for rr in resp.answers), default=now)
+                    self.packets.set(packet_key, encoded, ttl_offsets, min(expiration, refresh_at), now)
+        else:  # forward to upstream
+            logging.info('forwarding to upstream')
             try:
-                # check existence and TTL of cache
-                valid = all((self.server.cache[q.cache_key].expiration >= now for q in query.questions))
-            except KeyError:
-                valid = False
-
-            if valid:  # use cached records
-                resp = Message()
-                resp.header['id'] = query.header['id']
-                resp.header['rd'] = query.header['rd']
-                resp.header['ra'] = False  # recursive query not supported currently
-                resp.questions = query.questions
-                resp.answers = [self.server.cache[q.cache_key] for q in query.questions]
-                logging.info('cached records used')
-            else:  # forward to upstream
-                logging.info('forwarding to upstream')
-                upstream_resp = send_and_recv_datagram(self.server.upstream_address, query_data, self.server.buf_size)
-                resp = Message.parse(upstream_resp)
+                # shielded, for the others waiting not to be cancelled along with this handler
+                upstream_resp = await asyncio.shield(self.forward(key, query_data))
+            except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+                logging.warning('no valid response from upstream: %r', e)
+                resp = Message.server_failure(query)
+            else:
                 logging.info('got response from upstream')
-                for rr in resp.answers:
-                    self.server.cache[rr.cache_key] = rr
-                    logging.info('cache: record %s added or updated', rr.cache_key)
-                for rr in resp.authority:
-                    self.server.cache[rr.cache_key] = rr
-                    logging.info('cache: record %s added or updated', rr.cache_key)
-                for rr in resp.additional:
-                    # EDNS ignored
-                    if rr.r_type in (Message.QType.A, Message.QType.AAAA, Message.QType.CNAME,
-                                     Message.QType.TXT, Message.QType.NS, Message.QType.MX):
-                        self.server.cache[rr.cache_key] = rr
-                        logging.info('cache: record %s added or updated', rr.cache_key)
-
-            self.wfile.write(resp.encode())
-            logging.info('%d answers replied to client', resp.header['an_count'])
-
-    def __init__(self, upstream_host, upstream_port=53, hostname='localhost', serving_port=53, buf_size=4096):
-        super().__init__((hostname, serving_port), DNSResolver.QueryHandler)
-        self.upstream_address = upstream_host, upstream_port
-        self.buf_size = buf_size
-        self.cache = {}
+                # relayed as is, parsed already, with the ID of this query and its question in its own case
+                questions_end = query.questions_end
+                if upstream_resp[12:questions_end].lower() == query_data[12:questions_end].lower():
+                    encoded = b''.join((query_data[:2], upstream_resp[2:12], query_data[12:questions_end],
+                                        upstream_resp[questions_end:]))
+                else:
+                    encoded = query_data[:2] + upstream_resp[2:]
+
+        if encoded is None:
+            encoded = resp.encode()
+        self.transport.sendto(encoded, client_address)
+        logging.info('%d answers replied to client', encoded[6] << 8 | encoded[7])
+
+    def forward(self, key: tuple, query_data: bytes) -> asyncio.Task:
+        """
+        Forward a query to the upstream server and cache its response, unless the same is in flight already
+
+        :param key: the cache keys of the questions of the query
+        :return: the task of the response, shared by all the queries with the same key
+        """
+        forwarding = self._in_flight.get(key)
+        if forwarding is None:
+            forwarding = self._in_flight[key] = asyncio.ensure_future(self._forward(key, query_data))
+            forwarding.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            forwarding.add_done_callback(DNSResolver._log_failure)
+        else:
+            logging.info('same query in flight already')
+        return forwarding
+
+    async def _forward(self, key: tuple, query_data: bytes) -> bytes:
+        upstream_resp = await self.upstream.query(query_data)
+        resp = LazyMessage(upstream_resp)
+        self.update_cache(resp)
+        if self.shared is not None and resp.answers:
+            self.shared.set(DNSResolver._shared_key(key), upstream_resp, min(rr.expiration for rr in resp.answers))
+        return upstream_resp
+
+    def load_shared(self, key: tuple, now: float) -> bool:
+        """Cache the response got by another worker to the same query, if any, returning whether there is one"""
+        shared = self.shared.get(DNSResolver._shared_key(key), now)
+        if shared is None:
+            return False
+        upstream_resp, stored = shared
+        try:
+            self.update_cache(LazyMessage(upstream_resp), now - stored)
+        except ValueError:
+            return False
+        logging.info('response of another worker used')
+        return True
+
+    @staticmethod
+    def _shared_key(key: tuple) -> bytes:
+        return '\n'.join('{} {} {}'.format(*cache_key) for cache_key in key).encode()
+
+    @staticmethod
+    def _log_failure(forwarding: asyncio.Task):
+        # retrieved here for refreshes in the background, which no one waits for
+        if not forwarding.cancelled() and forwarding.exception() is not None:
+            logging.info('upstream query failed: %r', forwarding.exception())
+
+    def cached_response(self, query: Message, now: float) -> Tuple[Optional[Message], float]:
+        """
+        Answer a query with the RRsets cached
+
+        :return: the response, or None if some RRset is not cached, and when the first RRset used is due for a
+                 refresh
+        """
+        answers = []
+        refresh_at = math.inf
+        for question in query.questions:
+            records, due = self.lookup(question, now)
+            if records is None:
+                return None, refresh_at
+            answers.extend(records)
+            refresh_at = min(refresh_at, due)
+        resp = Message()
+        resp.header['id'] = query.header['id']
+        resp.header['qr'] = Message.MsgType.Response
+        resp.header['rd'] = query.header['rd']
+        resp.header['ra'] = False  # recursive query not supported currently
+        resp.questions = query.questions
+        resp.answers = answers
+        return resp, refresh_at
+
+    def lookup(self, question: Message.Question, now: float) -> Tuple[Optional[list], float]:
+        """
+        Answer a question with the RRsets cached, following the chain of CNAMEs from its name
+
+        :return: the records answering it, or None if some RRset on the way is not cached,
+                 and when the first RRset on the way is due for a refresh
+        """
+        answers = []
+        refresh_at = math.inf
+        name = question.name
+        for _ in range(DNSResolver.MAX_CNAME_CHAIN):
+            entry = self.cache.get(Message.Question(name, question.q_type, question.q_class).cache_key, now)
+            if entry is None and question.q_type != Message.QType.CNAME.value:
+                alias = Message.Question(name, Message.QType.CNAME.value, question.q_class)
+                entry = self.cache.get(alias.cache_key, now)
+            if entry is None:
+                return None, refresh_at
+            records = entry.records
+            if records[0].expiration < now:  # stale, only cached still with serve_stale
+                records = [rr._replace(expiration=now + DNSResolver.STALE_ANSWER_TTL) for rr in records]
+                refresh_at = now
+            refresh_at = min(refresh_at, entry.refresh_at)
+            answers.extend(records)
+            if records[0].r_type != Message.QType.CNAME.value or question.q_type == Message.QType.CNAME.value:
+                return answers, refresh_at
+            name, _ = Message.parse_name(records[0].r_data, 0)
+        return None, refresh_at
+
+    def update_cache(self, resp: Message, age: float = 0.):
+        """
+        Cache the RRsets of a response, each under its (name, type, class) as a whole
+
+        :param age: seconds since the response was received, to take off the TTLs
+        """
+        # EDNS and other records of the additional section ignored
+        additional = [rr for rr in resp.additional if rr.r_type in (
+            Message.QType.A.value, Message.QType.AAAA.value, Message.QType.CNAME.value,
+            Message.QType.TXT.value, Message.QType.NS.value, Message.QType.MX.value)]
+        rrsets = {}
+        for section in (resp.answers, resp.authority, additional):
+            section_rrsets = {}
+            for rr in section:
+                section_rrsets.setdefault(rr.cache_key, []).append(rr)
+            for key, rrset in section_rrsets.items():
+                # data of the sections after are less trustworthy (RFC 2181 5.4.1), additional data the least
+                if key not in rrsets and not (section is additional and key in self.cache):
+                    rrsets[key] = rrset
+        now = time.time()
+        for key, rrset in rrsets.items():
+            expiration = min(rr.expiration for rr in rrset) - age  # one TTL for an RRset (RFC 2181 5.2)
+            rrset = tuple(rr._replace(expiration=expiration) for rr in rrset)
+            refresh_at = now + (expiration - now) * self.prefetch if self.prefetch is not None else math.inf
+            size = sum(len(rr.r_data) + sum(len(label) + 1 for label in rr.name) for rr in rrset)
+            self.cache.set(key, RRsetEntry(rrset, refresh_at),
+                           expiration + (self.stale_ttl if self.serve_stale else 0), size, now)
+            logging.info('cache: RRset %s of %d records added or updated', key, len(rrset))
+
+
+def run_worker(resolver_kwargs: dict, shared: SharedCache):
+    logging.info('worker %d serving', os.getpid())
+    try:
+        asyncio.run(DNSResolver(reuse_port=True, shared=shared, **resolver_kwargs).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(workers: int, shared_slots: int = 16384, **resolver_kwargs):
+    """
+    Serve with worker processes, each with a resolver of its own bound to the same port with SO_REUSEPORT,
+    so that the kernel spreads the queries over them, and all of them sharing the responses of the upstream server
+
+    :param resolver_kwargs: arguments of DNSResolver
+    """
+    shared = SharedCache(slots=shared_slots)
+    context = multiprocessing.get_context('fork')  # for the workers to inherit the shared cache
+    processes = [context.Process(target=run_worker, args=(resolver_kwargs, shared), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())  # for the workers to be stopped as well
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Local DNS resolver')
+    parser.add_argument('--upstream', default='ns2.sustc.edu.cn', help='host of the upstream server')
+    parser.add_argument('--port', type=int, default=53, help='port to serve')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes sharing the port and the cache')
+    parser.add_argument('--serve-stale', action='store_true', help='answer with expired records while refreshing')
+    args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(asctime)s: %(message)s')
 
     logging.info('Local DNS resolver working')
-    server = DNSResolver(upstream_host='ns2.sustc.edu.cn', upstream_port=53, hostname='localhost', serving_port=53)
+    resolver_kwargs = dict(upstream_host=args.upstream, upstream_port=53, hostname='localhost', serving_port=args.port,
+                           serve_stale=args.serve_stale)
     try:
-        server.serve_forever()
+        if args.workers > 1:
+            serve_workers(args.workers, **resolver_kwargs)
+        else:
+            asyncio.run(DNSResolver(**resolver_kwargs).serve_forever())
     except KeyboardInterrupt:
         logging.info('Quit')
     except Exception:
@@ -0,0 +1,762 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of RDT, echoing alice.txt through a local server
+
+- compare:  Go-Back-N against Selective Repeat with the default network emulation
+- sweep:    both modes over a grid of emulated loss and delay rates
+- parallel: many pairs of sockets echoing at a time, all driven by one event loop
+- clients:  many client processes echoing at a time through one multiplexed server
+- codec:    segments per second that RDTSegment encodes and parses, and bytes copied per MB echoed
+- duplex:   small request/response exchanges, one message each way against a connection with piggybacked ACKs
+- fec:      completion time of one-way transfers with and without parity segments, over a path with latency
+- throughput: one-way transfers over loopback without impairments, with batched datagram I/O and without
+- suite:    one-way transfers between a server and a client process over a grid of payload sizes, windows,
+            impairments and modes, with the results also as JSON lines or CSV to track regressions
+"""
+
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import zlib
+from collections import namedtuple
+from rdt import RDTSegment, socket
+from time import perf_counter, process_time, strftime, time
+from typing import Callable, Iterator, Optional, Tuple
+
+
+SERVER_ADDR = '127.0.0.1'
+SERVER_PORT = 9999
+
+with open('alice.txt', 'rb') as f:
+    DATA = f.read()
+
+EchoResult = namedtuple('EchoResult', ['time', 'srtt', 'rto', 'cwnd'])
+
+
+def serve_once(port: int, selective_repeat: bool, impairments: dict, ready):
+    server = socket(selective_repeat=selective_repeat, **impairments)
+    server.bind((SERVER_ADDR, port))
+    ready.set()
+    try:
+        data, client_addr = server.recvfrom()
+        server.sendto(data, client_addr)
+    except ConnectionError:
+        pass  # reported by the client side
+
+
+def echo(selective_repeat: bool, port: int=SERVER_PORT, **impairments) -> Optional[EchoResult]:
+    """
+    Echoes DATA through a freshly started server process
+
+    :param impairments: network emulation parameters of UDPsocket, applied to both ends
+    :return: the round trip time and the final state of the client, or None if the transfer is aborted
+    """
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_once, args=(port, selective_repeat, impairments, ready))
+    server.start()
+    if not ready.wait(5):
+        raise RuntimeError('failed to start the server')
+    try:
+        client = socket(selective_repeat=selective_repeat, **impairments)
+        start_time = time()
+        try:
+            client.sendto(DATA, (SERVER_ADDR, port))
+            data, server_addr = client.recvfrom()
+        except ConnectionError:
+            return None
+        rtt = time() - start_time
+        assert data == DATA
+        return EchoResult(rtt, client.srtt, client.rto, client.cwnd)
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+
+
+def compare(args):
+    print('Echoing {} bytes, {} round(s) for each mode'.format(len(DATA), args.rounds))
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        results = [echo(selective_repeat, args.port, seed=args.seed) for _ in range(args.rounds)]
+        times = [r.time for r in results if r is not None]
+        if times:
+            print('{:>4}: mean {:8.3f} s, min {:8.3f} s, max {:8.3f} s, aborted {}/{}'.format(
+                name, sum(times) / len(times), min(times), max(times), len(results) - len(times), len(results)))
+        else:
+            print('{:>4}: all {} transfers aborted'.format(name, len(results)))
+
+
+def sweep(args):
+    print('Echoing {} bytes, corruption rate {}, delay {} s'.format(len(DATA), args.corruption_rate, args.delay))
+    print('{:>6} {:>10} {:>4} {:>9} {:>12} {:>9} {:>9} {:>6}'.format(
+        'loss', 'delay rate', 'mode', 'time/s', 'goodput/KBps', 'srtt/ms', 'rto/ms', 'cwnd'))
+    for loss_rate in args.loss_rates:
+        for delay_rate in args.delay_rates:
+            for name, selective_repeat in (('GBN', False), ('SR', True)):
+                r = echo(selective_repeat, args.port, loss_rate=loss_rate, corruption_rate=args.corruption_rate,
+                         delay_rate=delay_rate, delay=args.delay, seed=args.seed)
+                if r is None:
+                    print('{:>6} {:>10} {:>4} {:>9}'.format(loss_rate, delay_rate, name, 'aborted'))
+                    continue
+                print('{:>6} {:>10} {:>4} {:>9.3f} {:>12.1f} {:>9.2f} {:>9.2f} {:>6.1f}'.format(
+                    loss_rate, delay_rate, name, r.time, 2 * len(DATA) / r.time / 1024,
+                    (r.srtt or 0) * 1000, r.rto * 1000, r.cwnd))
+
+
+async def request(client: socket, server_addr: tuple) -> bytes:
+    """Send DATA to an echo server, returning the reply"""
+    reply = asyncio.ensure_future(client.arecvfrom())  # ready for the reply before the request is finished
+    try:
+        await client.asendto(DATA, server_addr)
+        data, server_addr = await reply
+    finally:
+        reply.cancel()
+    return data
+
+
+async def echo_pair(selective_repeat: bool, timeout: float, **impairments) -> bool:
+    """Echo DATA between two new sockets, returning whether it succeeded in `timeout` seconds"""
+    server = socket(selective_repeat=selective_repeat, **impairments)
+    server.bind((SERVER_ADDR, 0))
+    client = socket(selective_repeat=selective_repeat, **impairments)
+    client.bind((SERVER_ADDR, 0))
+
+    async def serve():
+        data, client_addr = await server.arecvfrom()
+        await server.asendto(data, client_addr)
+
+    async def check():
+        assert await request(client, server.getsockname()) == DATA
+
+    transfers = [asyncio.ensure_future(serve()), asyncio.ensure_future(check())]
+    done, pending = await asyncio.wait(transfers, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+    for transfer in pending:
+        transfer.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    server.close()
+    client.close()
+    for transfer in done:
+        if transfer.exception() is not None and not isinstance(transfer.exception(), ConnectionError):
+            raise transfer.exception()
+    return not pending and all(transfer.exception() is None for transfer in done)
+
+
+def serve_forever(port: int, selective_repeat: bool, ready):
+    server = socket(selective_repeat=selective_repeat)
+    server.bind((SERVER_ADDR, port))
+
+    async def echo(data: bytes, client_addr: tuple):
+        await server.asendto(data, client_addr)
+
+    ready.set()
+    asyncio.run(server.aserve(echo))
+
+
+def client_echo(args: tuple) -> Tuple[str, float]:
+    """Echo DATA in a client process, returning 'ok', 'aborted' or 'corrupted' along with the time taken"""
+    selective_repeat, port, timeout = args
+    client = socket(selective_repeat=selective_repeat)
+    start_time = time()
+    try:
+        data = asyncio.run(asyncio.wait_for(request(client, (SERVER_ADDR, port)), timeout))
+    except (ConnectionError, asyncio.TimeoutError):
+        return 'aborted', time() - start_time
+    # the 16-bit checksum lets through a tiny fraction of the corruption emulated by UDPsocket
+    return 'ok' if data == DATA else 'corrupted', time() - start_time
+
+
+def clients(args):
+    print('Echoing {} bytes from {} clients at a time through one server'.format(len(DATA), args.clients))
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve_forever, args=(args.port, selective_repeat, ready))
+        server.start()
+        try:
+            if not ready.wait(5):
+                raise RuntimeError('failed to start the server')
+            with multiprocessing.Pool(args.clients) as pool:
+                start_time = time()
+                results = pool.map(client_echo, [(selective_repeat, args.port, args.timeout)] * args.clients)
+                elapsed = time() - start_time
+        finally:
+            server.terminate()
+            server.join()
+        statuses = [status for status, _ in results]
+        times = [t for status, t in results if status == 'ok']
+        mean_time = sum(times) / len(times) if times else float('nan')
+        print('{:>4}: {:8.3f} s, goodput {:8.1f} KBps, mean echo {:8.3f} s, aborted {}, corrupted {}, of {}'.format(
+            name, elapsed, 2 * len(DATA) * len(times) / elapsed / 1024, mean_time,
+            statuses.count('aborted'), statuses.count('corrupted'), len(results)))
+
+
+def parallel(args):
+    print('Echoing {} bytes through {} pairs of sockets at a time, loss rate {}'.format(
+        len(DATA), args.pairs, args.loss_rate))
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        async def run_all():
+            impairments = dict(loss_rate=args.loss_rate, corruption_rate=0, delay_rate=0, seed=args.seed)
+            return await asyncio.gather(*(echo_pair(selective_repeat, args.timeout, **impairments)
+                                          for _ in range(args.pairs)))
+        start_time = time()
+        results = asyncio.run(run_all())
+        elapsed = time() - start_time
+        print('{:>4}: {:8.3f} s, goodput {:8.1f} KBps, aborted {}/{}'.format(
+            name, elapsed, 2 * len(DATA) * sum(results) / elapsed / 1024, results.count(False), len(results)))
+
+
+def words_checksum(segment: bytes) -> int:
+    """The checksum as it used to be computed, word by word in Python, for reference"""
+    i = iter(segment)
+    bytes_sum = sum(((a << 8) + b for a, b in zip(i, i)))
+    if len(segment) % 2 == 1:
+        bytes_sum += segment[-1] << 8
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+    return ~bytes_sum & 0xFFFF
+
+
+def rate(func, count: int) -> float:
+    """Calls of func per second"""
+    start_time = perf_counter()
+    for _ in range(count):
+        func()
+    return count / (perf_counter() - start_time)
+
+
+def codec(args):
+    payloads = [DATA[i:i+RDTSegment.MAX_PAYLOAD_LEN] for i in range(0, len(DATA), RDTSegment.MAX_PAYLOAD_LEN)]
+    segments = [RDTSegment(payload, seq_num=i, ack_num=0) for i, payload in enumerate(payloads)]
+    raw_segments = [segment.encode() for segment in segments]
+    for raw in raw_segments:
+        assert RDTSegment.calc_checksum(raw) == words_checksum(raw) == 0
+    rounds = max(args.count // len(segments), 1)
+
+    buffer = bytearray(RDTSegment.SEGMENT_LEN)
+    views = [memoryview(raw) for raw in raw_segments]
+    acks = [RDTSegment(None, seq_num=0, ack_num=i, ack=True, window=socket.WIN_SIZE) for i in range(len(segments))]
+    raw_acks = [ack.encode() for ack in acks]
+
+    def encode_all():
+        for segment in segments:
+            segment.encode()
+
+    def encode_into_all():
+        for segment in segments:
+            segment.encode_into(buffer)
+
+    def parse_all():
+        for raw in raw_segments:
+            RDTSegment.parse(raw)
+
+    def parse_views():
+        for view in views:
+            RDTSegment.parse(view)
+
+    def encode_acks():
+        for ack in acks:
+            ack.encode_into(buffer)
+
+    def parse_acks():
+        for raw in raw_acks:
+            RDTSegment.parse(raw)
+
+    def checksum_all(calc_checksum):
+        return lambda: [calc_checksum(raw) for raw in raw_segments]
+
+    print('{} segments of {} bytes, {} rounds'.format(len(segments), RDTSegment.SEGMENT_LEN, rounds))
+    for name, func in (('encode', encode_all), ('encode_into', encode_into_all),
+                       ('parse', parse_all), ('parse (memoryview)', parse_views),
+                       ('encode_into (ACK)', encode_acks), ('parse (ACK)', parse_acks),
+                       ('checksum', checksum_all(RDTSegment.calc_checksum)),
+                       ('checksum (word by word)', checksum_all(words_checksum))):
+        print('{:>24}: {:10.0f} segments/s'.format(name, rate(func, rounds) * len(segments)))
+
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        print('{:>24}: {:10.0f} bytes copied per MB echoed'.format(name, copies_per_mb(selective_repeat)))
+
+
+def copies_per_mb(selective_repeat: bool) -> float:
+    """Bytes copied by both ends of an echo without impairments, per MB transferred"""
+    server = socket(selective_repeat=selective_repeat, loss_rate=0, corruption_rate=0, delay_rate=0)
+    server.bind((SERVER_ADDR, 0))
+    client = socket(selective_repeat=selective_repeat, loss_rate=0, corruption_rate=0, delay_rate=0)
+    client.bind((SERVER_ADDR, 0))
+
+    async def serve():
+        data, client_addr = await server.arecvfrom()
+        await server.asendto(data, client_addr)
+
+    async def run():
+        _, data = await asyncio.gather(serve(), request(client, server.getsockname()))
+        assert data == DATA
+
+    asyncio.run(run())
+    server.close()
+    client.close()
+    return (server.bytes_copied + client.bytes_copied) / (2 * len(DATA) / 2 ** 20)
+
+
+class CountingSocket(socket):
+    """Socket counting the segments it sends, and how many of them are nothing but ACKs, or parity"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.segments_sent = 0
+        self.acks_sent = 0
+        self.parity_sent = 0
+
+    def _transmit(self, segment: RDTSegment, address: tuple, more: bool=False):
+        self.segments_sent += 1
+        if segment.ack and not segment.payload:
+            self.acks_sent += 1
+        if segment.parity:
+            self.parity_sent += 1
+        super()._transmit(segment, address, more)
+
+
+class AckDroppingSocket(CountingSocket):
+    """Socket losing the first data segment it sends with an ACK piggybacked, and nothing else"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dropped: Optional[int] = None  # sequence number of the segment lost
+        self.resent_with_ack = False  # whether a retransmission of it carries an ACK as well
+
+    def _transmit(self, segment: RDTSegment, address: tuple, more: bool=False):
+        if self.dropped is None and segment.ack and segment.payload:
+            self.dropped = segment.seq_num
+            return
+        if segment.seq_num == self.dropped and segment.payload:
+            self.resent_with_ack |= segment.ack
+        super()._transmit(segment, address, more)
+
+
+async def message_exchanges(server: socket, new_client: Callable[[], socket], request_data: bytes, count: int):
+    """
+    Exchanges by sendto() and recvfrom(), each from a new client socket (on a port not used by the others),
+    as a receiver lingers after the FIN of a message, dropping what comes from the same address in the meantime
+    """
+    async def echo(data: bytes, client_addr: tuple):
+        await server.asendto(data, client_addr)
+
+    serving = asyncio.ensure_future(server.aserve(echo))
+    try:
+        for _ in range(count):
+            client = new_client()
+            reply = asyncio.ensure_future(client.arecvfrom())
+            await client.asendto(request_data, server.getsockname())
+            data, _ = await reply
+            assert data == request_data
+    finally:
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+
+async def connection_exchanges(server: socket, new_client: Callable[[], socket], request_data: bytes, count: int):
+    """Exchanges through a connection, with the ACKs of either side piggybacked on its next data"""
+    async def serve():
+        connection, _ = await server.aaccept()
+        while True:
+            data = await connection.arecv(1 << 20)
+            if not data:
+                break
+            await connection.asend(data)
+        await connection.aclose()
+
+    async def run():
+        client = new_client()
+        await client.aconnect(server.getsockname())
+        for _ in range(count):
+            await client.asend(request_data)
+            data = b''
+            while len(data) < len(request_data):
+                data += await client.arecv(1 << 20)
+            assert data == request_data
+        await client.aclose()
+
+    server.listen()
+    await asyncio.gather(serve(), run())
+
+
+def duplex(args):
+    request_data = DATA[:args.size]
+    print('{} exchanges of {} bytes each way, loss rate {}'.format(args.count, len(request_data), args.loss_rate))
+    print('{:>4} {:>10} {:>12} {:>14} {:>14}'.format('mode', 'API', 'exchanges/s', 'segments/exch', 'ACK-only/exch'))
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        for api, exchanges in (('message', message_exchanges), ('connection', connection_exchanges)):
+            impairments = dict(loss_rate=args.loss_rate, corruption_rate=0, delay_rate=0, seed=args.seed)
+            sockets = [CountingSocket(selective_repeat=selective_repeat, **impairments)]
+            sockets[0].bind((SERVER_ADDR, 0))
+
+            def new_client() -> socket:
+                sockets.append(CountingSocket(selective_repeat=selective_repeat, **impairments))
+                return sockets[-1]
+
+            start_time = perf_counter()
+            asyncio.run(exchanges(sockets[0], new_client, request_data, args.count))
+            elapsed = perf_counter() - start_time
+            for sock in sockets:
+                sock.close()
+            print('{:>4} {:>10} {:>12.1f} {:>14.2f} {:>14.2f}'.format(
+                name, api, args.count / elapsed, sum(s.segments_sent for s in sockets) / args.count,
+                sum(s.acks_sent for s in sockets) / args.count))
+
+    # the ACK piggybacked on a response lost along with it, which the retransmissions of the response carry again
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        impairments = dict(loss_rate=0, corruption_rate=0, delay_rate=0)
+        sockets = [AckDroppingSocket(selective_repeat=selective_repeat, **impairments)]
+        sockets[0].bind((SERVER_ADDR, 0))
+
+        def new_client() -> socket:
+            sockets.append(CountingSocket(selective_repeat=selective_repeat, **impairments))
+            return sockets[-1]
+
+        start_time = perf_counter()
+        asyncio.run(asyncio.wait_for(connection_exchanges(sockets[0], new_client, request_data, 3),
+                                     socket.IDLE_TIMEOUT))
+        elapsed = perf_counter() - start_time
+        for sock in sockets:
+            sock.close()
+        assert sockets[0].dropped is not None and sockets[0].resent_with_ack
+        print('{:>4}: 3 exchanges with the segment of the first piggybacked ACK lost, done in {:.3f} s'.format(
+            name, elapsed))
+
+
+async def timed_transfer(sender: socket, receiver: socket, data: bytes) -> Optional[float]:
+    """Seconds to send data from one socket to the other, None if the transfer is aborted or the data corrupted"""
+    start_time = perf_counter()
+    receipt = asyncio.ensure_future(receiver.arecvfrom())
+    try:
+        await sender.asendto(data, receiver.getsockname())
+        rcvd_data, _ = await receipt
+    except ConnectionError:
+        return None
+    finally:
+        receipt.cancel()
+        await asyncio.gather(receipt, return_exceptions=True)
+    # the 16-bit checksum lets through a tiny fraction of the corruption emulated by UDPsocket
+    return perf_counter() - start_time if rcvd_data == data else None
+
+
+def fec(args):
+    data = (DATA * (args.size // len(DATA) + 1))[:args.size]
+    print('Sending {} bytes, {} round(s), corruption rate {}, one-way delay {} s'.format(
+        len(data), args.rounds, args.corruption_rate, args.delay))
+    print('{:>6} {:>4} {:>4} {:>9} {:>12} {:>9} {:>8} {:>7}'.format(
+        'loss', 'mode', 'FEC', 'time/s', 'goodput/KBps', 'segments', 'parity', 'failed'))
+    for loss_rate in args.loss_rates:
+        for name, selective_repeat in (('GBN', False), ('SR', True)):
+            for with_fec in (False, True):
+                impairments = dict(loss_rate=loss_rate, corruption_rate=args.corruption_rate,
+                                   delay_rate=1 if args.delay else 0, delay=args.delay, seed=args.seed)
+                times, segments, parity = [], 0, 0
+                for _ in range(args.rounds):
+                    sender = CountingSocket(selective_repeat=selective_repeat, fec=with_fec, **impairments)
+                    sender.bind((SERVER_ADDR, 0))
+                    receiver = socket(selective_repeat=selective_repeat, **impairments)
+                    receiver.bind((SERVER_ADDR, 0))
+                    elapsed = asyncio.run(timed_transfer(sender, receiver, data))
+                    sender.close()
+                    receiver.close()
+                    if elapsed is not None:
+                        times.append(elapsed)
+                        segments += sender.segments_sent
+                        parity += sender.parity_sent
+                if not times:
+                    print('{:>6} {:>4} {:>4} {:>9}'.format(loss_rate, name, 'on' if with_fec else 'off', 'aborted'))
+                    continue
+                mean_time = sum(times) / len(times)
+                print('{:>6} {:>4} {:>4} {:>9.3f} {:>12.1f} {:>9.0f} {:>8.0f} {:>7}'.format(
+                    loss_rate, name, 'on' if with_fec else 'off', mean_time, len(data) / mean_time / 1024,
+                    segments / len(times), parity / len(times), args.rounds - len(times)))
+
+
+def throughput(args):
+    data = (DATA * (args.size // len(DATA) + 1))[:args.size]
+    print('Sending {} bytes over loopback without impairments, {} round(s)'.format(len(data), args.rounds))
+    print('{:>4} {:>7} {:>10} {:>9} {:>8} {:>12}'.format('mode', 'window', 'batch', 'time/s', 'MB/s', 'CPU s/MB'))
+    for name, selective_repeat in (('GBN', False), ('SR', True)):
+        for win_size in args.windows:
+            for max_batch in (1, socket.MAX_BATCH):
+                elapsed = cpu_time = 0
+                for _ in range(args.rounds):
+                    sender, receiver = (socket(selective_repeat=selective_repeat, win_size=win_size,
+                                               loss_rate=0, corruption_rate=0, delay_rate=0) for _ in range(2))
+                    for sock in (sender, receiver):
+                        sock.bind((SERVER_ADDR, 0))
+                        sock.max_batch = max_batch
+                    start_cpu = process_time()
+                    seconds = asyncio.run(timed_transfer(sender, receiver, data))
+                    cpu_time += process_time() - start_cpu
+                    sender.close()
+                    receiver.close()
+                    if seconds is None:
+                        raise RuntimeError('transfer aborted')
+                    elapsed += seconds
+                megabytes = args.rounds * len(data) / 2 ** 20
+                print('{:>4} {:>7} {:>10} {:>9.3f} {:>8.1f} {:>12.4f}'.format(
+                    name, win_size, max_batch, elapsed / args.rounds, megabytes / elapsed, cpu_time / megabytes))
+
+
+SUITE_MODES = {'gbn': (False, False), 'sr': (True, False), 'gbn-fec': (False, True), 'sr-fec': (True, True)}
+SUITE_FIELDS = ['commit', 'started', 'mode', 'size', 'window', 'loss_rate', 'corruption_rate', 'delay_rate', 'delay',
+                'seed', 'status', 'completion_time', 'throughput', 'retransmission_ratio', 'segments_sent',
+                'retransmits', 'timeouts']
+
+
+def parse_size(text: str) -> int:
+    """Parse a number of bytes such as 1500, 64K or 100M"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def payload(size: int, chunk_size: int=1 << 20) -> Iterator[bytes]:
+    """Chunks of DATA repeated up to `size` bytes, never all in memory at once"""
+    block = DATA * (chunk_size // len(DATA) + 1)
+    for offset in range(0, size, chunk_size):
+        yield block[:min(chunk_size, size - offset)]
+
+
+class ChecksumSink:
+    """File object that only keeps the length and the CRC-32 of what is written to it"""
+
+    def __init__(self):
+        self.length = 0
+        self.crc = 0
+
+    def write(self, data: bytes) -> int:
+        self.length += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        return len(data)
+
+
+def suite_server(selective_repeat: bool, win_size: int, impairments: dict, results):
+    server = socket(selective_repeat=selective_repeat, win_size=win_size, **impairments)
+    server.bind((SERVER_ADDR, 0))
+    results.put(server.getsockname())
+    sink = ChecksumSink()
+    try:
+        server.recv_into(sink)
+        results.put(('ok', sink.length, sink.crc, server.stats.as_dict()))
+    except ConnectionError:
+        results.put(('aborted', sink.length, sink.crc, server.stats.as_dict()))
+    finally:
+        server.close()
+
+
+def suite_client(address: tuple, size: int, selective_repeat: bool, win_size: int, with_fec: bool,
+                 impairments: dict, results):
+    client = socket(selective_repeat=selective_repeat, win_size=win_size, fec=with_fec, **impairments)
+    start_time = perf_counter()
+    try:
+        client.sendto(payload(size), address)
+        status = 'ok'
+    except ConnectionError:
+        status = 'aborted'
+    results.put((status, perf_counter() - start_time, client.stats.as_dict()))
+    client.close()
+
+
+def transfer(size: int, selective_repeat: bool, win_size: int, with_fec: bool, timeout: float,
+             **impairments) -> dict:
+    """
+    Send `size` bytes from a client process to a server process, both freshly started
+
+    :return: the status ('ok', 'aborted', 'corrupted' or 'timeout'), the completion time seen by the client,
+             and the statistics of both ends (None for the ends that timed out)
+    """
+    server_results, client_results = multiprocessing.Queue(), multiprocessing.Queue()
+    server = multiprocessing.Process(target=suite_server,
+                                     args=(selective_repeat, win_size, impairments, server_results))
+    server.start()
+    processes = [server]
+    try:
+        address = server_results.get(timeout=5)
+        client = multiprocessing.Process(target=suite_client, args=(
+            address, size, selective_repeat, win_size, with_fec, impairments, client_results))
+        client.start()
+        processes.append(client)
+        try:
+            status, elapsed, sender = client_results.get(timeout=timeout)
+            status, length, crc, receiver = server_results.get(timeout=timeout) if status == 'ok' else (
+                status, 0, 0, None)
+        except queue.Empty:
+            return dict(status='timeout', completion_time=None, sender=None, receiver=None)
+        if status == 'ok' and (length, crc) != (size, expected_crc(size)):
+            status = 'corrupted'
+        return dict(status=status, completion_time=elapsed, sender=sender, receiver=receiver)
+    finally:
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+_crcs = {}
+
+
+def expected_crc(size: int) -> int:
+    if size not in _crcs:
+        crc = 0
+        for chunk in payload(size):
+            crc = zlib.crc32(chunk, crc)
+        _crcs[size] = crc
+    return _crcs[size]
+
+
+def commit() -> Optional[str]:
+    """Abbreviated hash of the commit checked out, suffixed by '+' if the tree is modified"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here,
+                               capture_output=True, text=True)
+    except OSError:
+        return None
+    if head.returncode:
+        return None
+    return head.stdout.strip() + ('+' if dirty.stdout.strip() else '')
+
+
+def suite(args):
+    out = open(args.output, 'a', newline='') if args.output else sys.stdout
+    writer = None
+    if args.format == 'csv':
+        writer = csv.DictWriter(out, SUITE_FIELDS, extrasaction='ignore')
+        if not args.output or out.tell() == 0:
+            writer.writeheader()
+    elif args.format == 'table':
+        print('{:>7} {:>10} {:>6} {:>6} {:>6} {:>6} {:>8} {:>9} {:>8} {:>7}'.format(
+            'mode', 'size', 'window', 'loss', 'corr', 'delay', 'status', 'time/s', 'MB/s', 'retx'), file=out)
+    version = commit()
+    grid = itertools.product(args.modes, args.sizes, args.windows, args.loss_rates, args.corruption_rates,
+                             args.delay_rates)
+    for mode, size, window, loss_rate, corruption_rate, delay_rate in grid:
+        selective_repeat, with_fec = SUITE_MODES[mode]
+        impairments = dict(loss_rate=loss_rate, corruption_rate=corruption_rate, delay_rate=delay_rate,
+                           delay=args.delay, seed=args.seed)
+        for _ in range(args.rounds):
+            started = strftime('%Y-%m-%dT%H:%M:%S%z')
+            result = transfer(size, selective_repeat, window, with_fec, args.timeout, **impairments)
+            sender = result['sender'] or {}
+            elapsed = result['completion_time']
+            ok = result['status'] == 'ok'
+            record = dict(commit=version, started=started, mode=mode, size=size, window=window, **impairments,
+                          status=result['status'], completion_time=elapsed,
+                          throughput=size / elapsed if ok and elapsed else None,
+                          retransmission_ratio=sender['retransmits'] / sender['segments_sent']
+                          if sender.get('segments_sent') else None,
+                          segments_sent=sender.get('segments_sent'), retransmits=sender.get('retransmits'),
+                          timeouts=sender.get('timeouts'), sender=result['sender'], receiver=result['receiver'])
+            if args.format == 'jsonl':
+                print(json.dumps(record), file=out)
+            elif writer is not None:
+                writer.writerow(record)
+            else:
+                print('{:>7} {:>10} {:>6} {:>6} {:>6} {:>6} {:>8} {:>9} {:>8} {:>7}'.format(
+                    mode, size, window, loss_rate, corruption_rate, delay_rate, record['status'],
+                    '{:.3f}'.format(elapsed) if elapsed is not None else '-',
+                    '{:.2f}'.format(record['throughput'] / 2 ** 20) if record['throughput'] else '-',
+                    '{:.3f}'.format(record['retransmission_ratio'])
+                    if record['retransmission_ratio'] is not None else '-'), file=out)
+            out.flush()
+    if args.output:
+        out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--seed', type=int, help='of the network emulation of every socket, for comparable runs')
+    subparsers = parser.add_subparsers(dest='command')
+
+    compare_parser = subparsers.add_parser('compare', help='GBN against SR (default)')
+    compare_parser.add_argument('-n', '--rounds', type=int, default=1, help='number of transfers for each mode')
+
+    sweep_parser = subparsers.add_parser('sweep', help='loss/delay sweep')
+    sweep_parser.add_argument('--loss-rates', type=float, nargs='+', default=[0, .01, .05, .1, .2])
+    sweep_parser.add_argument('--delay-rates', type=float, nargs='+', default=[0, .05])
+    sweep_parser.add_argument('--delay', type=float, default=.05, help='seconds of each emulated delay')
+    sweep_parser.add_argument('--corruption-rate', type=float, default=0)
+
+    parallel_parser = subparsers.add_parser('parallel', help='concurrent transfers in one process')
+    parallel_parser.add_argument('-n', '--pairs', type=int, default=100, help='number of concurrent echoes')
+    parallel_parser.add_argument('--loss-rate', type=float, default=.01)
+    parallel_parser.add_argument('--timeout', type=float, default=300, help='seconds before an echo is aborted')
+
+    clients_parser = subparsers.add_parser('clients', help='concurrent clients of one server')
+    clients_parser.add_argument('-n', '--clients', type=int, default=20, help='number of client processes')
+    clients_parser.add_argument('--timeout', type=float, default=300, help='seconds before an echo is aborted')
+
+    codec_parser = subparsers.add_parser('codec', help='encoding and parsing micro-benchmark')
+    codec_parser.add_argument('-n', '--count', type=int, default=20000, help='number of segments to process')
+
+    duplex_parser = subparsers.add_parser('duplex', help='request/response exchanges, messages against a connection')
+    duplex_parser.add_argument('-n', '--count', type=int, default=200, help='number of exchanges')
+    duplex_parser.add_argument('--size', type=int, default=100, help='bytes of each request and response')
+    duplex_parser.add_argument('--loss-rate', type=float, default=0)
+
+    fec_parser = subparsers.add_parser('fec', help='transfers with and without forward error correction')
+    fec_parser.add_argument('-n', '--rounds', type=int, default=1, help='number of transfers for each setting')
+    fec_parser.add_argument('--size', type=int, default=1 << 20, help='bytes of each transfer')
+    fec_parser.add_argument('--loss-rates', type=float, nargs='+', default=[.01, .05, .1])
+    fec_parser.add_argument('--corruption-rate', type=float, default=0)
+    fec_parser.add_argument('--delay', type=float, default=.02, help='seconds each segment is delayed by')
+
+    throughput_parser = subparsers.add_parser('throughput', help='loopback throughput, batched I/O against not')
+    throughput_parser.add_argument('-n', '--rounds', type=int, default=1, help='number of transfers for each setting')
+    throughput_parser.add_argument('--size', type=int, default=20 << 20, help='bytes of each transfer')
+    throughput_parser.add_argument('--windows', type=int, nargs='+', default=[64, 256, 1024],
+                                   help='window sizes, in segments')
+
+    suite_parser = subparsers.add_parser('suite', help='transfers between processes over a grid of settings')
+    suite_parser.add_argument('-n', '--rounds', type=int, default=1, help='number of transfers for each setting')
+    suite_parser.add_argument('--sizes', type=parse_size, nargs='+',
+                              default=[1 << 10, 100 << 10, 1 << 20, 10 << 20, 100 << 20],
+                              help='bytes of each transfer, with K, M or G suffixes')
+    suite_parser.add_argument('--windows', type=int, nargs='+', default=[64, 1024], help='window sizes, in segments')
+    suite_parser.add_argument('--modes', nargs='+', choices=SUITE_MODES, default=['gbn', 'sr'])
+    suite_parser.add_argument('--loss-rates', type=float, nargs='+', default=[0, .01])
+    suite_parser.add_argument('--corruption-rates', type=float, nargs='+', default=[0])
+    suite_parser.add_argument('--delay-rates', type=float, nargs='+', default=[0])
+    suite_parser.add_argument('--delay', type=float, default=.05, help='seconds of each emulated delay')
+    suite_parser.add_argument('--timeout', type=float, default=600, help='seconds before a transfer is given up')
+    suite_parser.add_argument('--format', choices=['table', 'jsonl', 'csv'], default='table')
+    suite_parser.add_argument('-o', '--output', help='file to append the results to, instead of stdout')
+
+    args = parser.parse_args()
+    if args.command == 'sweep':
+        sweep(args)
+    elif args.command == 'parallel':
+        parallel(args)
+    elif args.command == 'clients':
+        clients(args)
+    elif args.command == 'codec':
+        codec(args)
+    elif args.command == 'duplex':
+        duplex(args)
+    elif args.command == 'fec':
+        fec(args)
+    elif args.command == 'throughput':
+        throughput(args)
+    elif args.command == 'suite':
+        suite(args)
+    else:
+        if args.command is None:
+            args.rounds = 1
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
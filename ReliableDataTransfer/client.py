@@ -7,6 +7,7 @@ from time import time
 
 SERVER_ADDR = '127.0.0.1'
 SERVER_PORT = 9999
+BUFFER_SIZE = 65536
 
 with open('alice.txt', 'rb') as f:
     DATA = f.read()
@@ -16,9 +17,18 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='[CLIENT %(levelname)s] %(asctime)s: %(message)s')
     client = socket()
     start_time = time()
-    client.sendto(DATA, (SERVER_ADDR, SERVER_PORT))
-    data, server_addr = client.recvfrom()
+    client.connect((SERVER_ADDR, SERVER_PORT))
+    client.send(DATA)
+    data = bytearray()
+    while len(data) < len(DATA):
+        chunk = client.recv(BUFFER_SIZE)
+        if not chunk:
+            break
+        data.extend(chunk)
     rtt = time() - start_time
+    client.close()
     assert data == DATA
-    print('Received: ', data)
+    print('Received: ', bytes(data))
     print('Round trip time:', rtt)
+    print('Smoothed RTT: {}, RTO: {}'.format(client.srtt, client.rto))
+    print('Statistics:', client.stats.summary())
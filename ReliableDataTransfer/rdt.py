@@ -1,192 +1,1790 @@
-"""Reliable Data Transfer over Unreliable Transport Layer Using Go-Back-N Strategy"""
+"""Reliable Data Transfer over Unreliable Transport Layer Using Go-Back-N or Selective Repeat Strategy"""
 
 __author__ = 'Jeeken (Wang Ziqin)'
 __email__ = '11712310@mail.sustc.edu.cn'
 
 
-# TODO:
-# - Connection Establishment
-# - Full duplex support
-
+import asyncio
+import heapq
 import logging
-import signal
 import struct
+import sys
 
+from bisect import bisect_right
 from collections import deque
-from socket import timeout as TimeoutException
-from typing import Tuple, Union
+from contextlib import contextmanager
+from socket import IPPROTO_UDP, SOL_SOCKET, SO_RCVBUF, timeout as TimeoutException
+from time import monotonic
+from typing import (AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
 from udp import UDPsocket
 
 
+UDP_SEGMENT = 103  # UDP generic segmentation offload of Linux 4.18+, not exposed by the socket module
+
+
 class socket(UDPsocket):
     """
-    Connectionless Reliable Data Transfer Socket
+    Reliable Data Transfer Socket, connectionless with sendto() and recvfrom(), or connected with connect()
+    and accept() (see Connection)
     """
     MAX_RETRY_TIMES = 5
-    TIMEOUT = .5
-    WIN_SIZE = 6
+    TIMEOUT = .5  # to start with, the retransmission timeout being estimated from the ACK latency (see RTTEstimator)
+    MAX_BACKOFFS = 10  # retransmission timeouts in a row without a reply, after which transfers and connecting give up
+    # without a valid segment from the peer, after which receipts give up: MAX_BACKOFFS times RTTEstimator.MAX_RTO,
+    # the longest that the peer retransmits for
+    IDLE_TIMEOUT = 40.
+    LINGER = 2  # after a FIN, for which retransmitted FINs are acknowledged and stale segments dropped (TIME_WAIT)
+    FALLBACK_TIMEOUTS = 2  # without a reply, after which version 1 is spoken (see _fall_back())
+    WIN_SIZE = 64
+    ACK_DELAY = .04  # the minimum delayed ACK timeout of Linux
+    BACKLOG = 128
+    MAX_BATCH = 64  # the most segments UDP segmentation offload takes at once
+    MAX_BATCH_LEN = 0xFFFF - 8 - 20  # the longest UDP payload over IPv4
+    MAX_PATHS = 1024  # peers whose RTT estimates are kept
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, selective_repeat: bool=False, win_size: int=WIN_SIZE, fec: bool=False, **impairments):
+        """
+        :param selective_repeat: whether the receiver buffers out-of-order segments and acknowledges each of them,
+                                 and the sender retransmits only the ones timing out, rather than Go-Back-N;
+                                 both peers must use the same mode
+        :param win_size: segments the receiver has room for, capped by the sequence numbers (see RDTSegment)
+        :param fec: whether a parity segment follows every group of data segments sent (see FecController)
+        :param impairments: of the network emulated (see UDPsocket)
+        """
+        super().__init__(**impairments)
+        self.selective_repeat = selective_repeat
+        self.win_size = min(win_size, RDTSegment.MAX_WINDOW)
+        self.fec = fec
+        self.stats = TransferStats()
+        # seconds between summaries of the stats logged while transfers are in progress, if any; segments are logged
+        # one by one only at the DEBUG level, as formatting a line for each costs more than the rest of their processing
+        self.stats_interval: Optional[float] = None
+        self._stats_timer: Optional[asyncio.TimerHandle] = None
+        self.setblocking(False)
+        self._senders: Dict[tuple, _Mailbox] = {}  # peer address -> ACKs from it
+        self._receivers: Dict[tuple, _Mailbox] = {}  # peer address -> other segments from it, None if corrupted
+        self._on_new_peer: Optional[Callable[[tuple], None]] = None  # to set up a receiver for a new peer
+        self._unclaimed = deque()  # (data, address, buffer) read in a batch before there is a receiver for them
+        self._lingering: Dict[tuple, Tuple[float, RDTSegment]] = {}  # peer address -> (until when, FINACK)
+        self._refused: Dict[tuple, Tuple[RDTSegment, int]] = {}  # peer address -> (ACK of window 0, window)
+        self._peer_versions: Dict[tuple, int] = {}  # peer address -> version of the latest segment from it
+        self._paths: Dict[tuple, _Path] = {}  # peer address -> state of the transfers with it, least recent first
+        self._latest_path = _Path(fec)  # of the latest transfer sent or connection made
+        self._decoders: Dict[tuple, _ParityDecoder] = {}  # peer address -> its data, for as long as it is received from
+        self._connections: Dict[tuple, Connection] = {}  # peer address -> connection with it
+        self._connection: Optional[Connection] = None  # made by connect()
+        self._connecting: Dict[tuple, _Mailbox] = {}  # peer address -> SYN-ACKs from it
+        self._backlog: Optional[_Mailbox] = None  # connections not accepted yet, since listen()
+        self._backlog_size = 0
+        self._held_acks: Dict[tuple, Tuple[RDTSegment, asyncio.TimerHandle]] = {}  # to be piggybacked on data
+        self._last_acks: Dict[tuple, RDTSegment] = {}  # peer address -> latest ACK to it, piggybacked on a connection
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # of the blocking methods
+        self._transfers = 0  # in progress, while which the event loop watches the socket
+        self._reading_timer: Optional[asyncio.TimerHandle] = None  # to stop watching it once no peer lingers
+        self._reading_loop: Optional[asyncio.AbstractEventLoop] = None  # watching it, for transfers or lingering peers
+        self.max_batch = socket.MAX_BATCH
+        self._send_buffer = bytearray(socket.MAX_BATCH_LEN)  # of the segments in the batch to send
+        self._batch_len = 0
+        self._batch_count = 0
+        self._batch_unit = 0  # length of the first segment in the batch
+        self._batch_address: Optional[tuple] = None
+        self._flush_handle: Optional[asyncio.Handle] = None  # of the flush scheduled at the end of the iteration
+        # (segments, unit, address) of the batches left once the send buffer is full, sent as it has room again
+        self._unsent: Deque[Tuple[bytes, int, tuple]] = deque()
+        self._writing_loop: Optional[asyncio.AbstractEventLoop] = None  # watching for room while batches are left
+        self._segmentation = sys.platform.startswith('linux')  # until the kernel says otherwise
+        self._buffers = _BufferPool(RDTSegment.SEGMENT_LEN, capacity=2 * self.win_size)
+        self.bytes_copied = 0  # payloads copied into segments to send and out of those received, padding included
+        # room in the kernel for a window of segments arriving at once, as far as the system allows
+        if self.getsockopt(SOL_SOCKET, SO_RCVBUF) < self.win_size * RDTSegment.SEGMENT_LEN:
+            self.setsockopt(SOL_SOCKET, SO_RCVBUF, self.win_size * RDTSegment.SEGMENT_LEN)
+
+    @property
+    def srtt(self) -> Optional[float]:
+        """Smoothed round-trip time to the peer of the latest transfer sent in seconds, None if not measured yet"""
+        return self._latest_path.rtt_estimator.srtt
+
+    @property
+    def rto(self) -> float:
+        """Current retransmission timeout to the peer of the latest transfer sent in seconds"""
+        return self._latest_path.rtt_estimator.rto
+
+    @property
+    def cwnd(self) -> float:
+        """Congestion window of the latest transfer sent, in segments"""
+        return self._latest_path.congestion.cwnd
+
+    def recvfrom(self) -> Tuple[bytearray, tuple]:
+        """Receive a whole message from whichever peer sends first, in a bytearray rather than copied into bytes"""
+        return self._run(self.arecvfrom())
+
+    def recv_stream(self) -> Iterator[Tuple[bytes, tuple]]:
+        """
+        Receive a message chunk by chunk, yielding (chunk, address) as the chunks arrive in order
+
+        Segments are only acknowledged as their chunks are taken, so that memory stays bounded by the window.
+        Closing the generator before the end aborts the receipt.
+        """
+        stream = self.arecv_stream()
+        try:
+            while True:
+                try:
+                    yield self._run(stream.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            self._run(stream.aclose())
+
+    def recv_into(self, file: BinaryIO) -> Tuple[int, tuple]:
+        """
+        Receive a message into a binary file object as it arrives
+
+        :return: the number of bytes received, and the address of the peer
+        """
+        return self._run(self.arecv_into(file))
+
+    def sendto(self, data_to_send: 'Sendable', address: tuple):
+        """Send bytes-like data, a binary file object or an iterable of chunks, the latter two read as they are sent"""
+        self._run(self.asendto(data_to_send, address))
+
+    def connect(self, address: tuple):
+        self._run(self.aconnect(address))
+
+    def listen(self, backlog: int=BACKLOG):
+        """Let peers connect to this socket, with up to `backlog` connections waiting for accept()"""
+        if self._backlog is None:
+            self._backlog = _Mailbox()
+        self._backlog_size = backlog
+
+    def accept(self) -> Tuple['Connection', tuple]:
+        return self._run(self.aaccept())
+
+    def send(self, data: 'Sendable'):
+        """Send data to the peer connected, returning once they are all sent, though not necessarily acknowledged"""
+        self._run(self.asend(data))
+
+    def recv(self, buffer_size: int) -> bytes:
+        """Receive up to buffer_size bytes from the peer connected, or b'' once it closes the connection"""
+        return self._run(self.arecv(buffer_size))
+
+    def _run(self, coroutine: Awaitable):
+        """
+        Run a coroutine in the event loop of the socket, kept across calls for connections to live on between them
+
+        A socket is not to be used by more than one event loop at a time.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        try:
+            return self._loop.run_until_complete(coroutine)
+        finally:
+            self._flush()
+
+    async def aconnect(self, address: tuple):
+        """
+        Coroutine version of connect(): send SYNs until a SYN-ACK comes back
+
+        Until then, data from the peer are received already, as it may send some as soon as it has replied.
+        """
+        if self._connection is not None:
+            raise RuntimeError('already connected')
+        connection = Connection(self, address)
+        syn_acks = self._connecting[address] = _Mailbox()
+        syn = RDTSegment(None, seq_num=0, ack_num=0, syn=True, window=self.win_size)
+        rtt = self._path(address).rtt_estimator
+        sent_at = monotonic()  # of the first SYN, None once retransmitted
+        backoffs = 0
+        try:
+            with self._watched():
+                while True:
+                    self._transmit(syn, address)
+                    try:
+                        await syn_acks.get(rtt.rto)
+                        break
+                    except TimeoutException:
+                        backoffs += 1
+                        if backoffs > socket.MAX_BACKOFFS:
+                            raise ConnectionRefusedError('no reply from {}:{}'.format(*address))
+                        rtt.backoff()
+                        sent_at = None
+        except BaseException:
+            await connection.aclose(finish=False)
+            raise
+        finally:
+            del self._connecting[address]
+        if sent_at is not None:  # Karn's algorithm
+            rtt.sample(monotonic() - sent_at)
+            self.stats.record_rtt(monotonic() - sent_at)
+        else:
+            rtt.reset_backoff()
+        self._connection = connection
+        logging.info('connected to %s:%d', *address)
+
+    async def aaccept(self) -> Tuple['Connection', tuple]:
+        """Coroutine version of accept(), waiting for a peer to connect if none is waiting yet"""
+        self.listen(self._backlog_size or socket.BACKLOG)
+        with self._watched():
+            connection = await self._backlog.get()
+        logging.info('accepted %s:%d', *connection.peer)
+        return connection, connection.peer
+
+    async def asend(self, data: 'Sendable'):
+        """Coroutine version of send()"""
+        await self._connected().asend(data)
 
-        # set timeout handler
-        def alarm_handler(signum, frame):
-            # logging.debug('SIGALRM: timed out!')
-            raise TimeoutException
-        signal.signal(signal.SIGALRM, alarm_handler)
+    async def arecv(self, buffer_size: int) -> bytes:
+        """Coroutine version of recv()"""
+        return await self._connected().arecv(buffer_size)
 
-    def recvfrom(self) -> Tuple[bytes, tuple]:
+    def _connected(self) -> 'Connection':
+        if self._connection is None:
+            raise RuntimeError('not connected')
+        return self._connection
+
+    async def arecvfrom(self) -> Tuple[bytearray, tuple]:
+        """Coroutine version of recvfrom(), receiving from whichever peer sends first"""
+        with self._watched():
+            address = await self._first_peer()
+            return await self._receive(address), address
+
+    async def arecv_stream(self) -> AsyncIterator[Tuple[bytes, tuple]]:
+        """Asynchronous generator version of recv_stream()"""
+        with self._watched():
+            address = await self._first_peer()
+            payloads = self._stream(address)
+            try:
+                async for payload in payloads:
+                    self.bytes_copied += len(payload)
+                    yield bytes(payload), address
+            finally:  # right away, even if this generator is closed early
+                await payloads.aclose()
+
+    async def arecv_into(self, file: BinaryIO) -> Tuple[int, tuple]:
+        """Coroutine version of recv_into(), whose writes to the file block the event loop"""
+        received = 0
+        with self._watched():
+            address = await self._first_peer()
+            async for payload in self._stream(address):
+                file.write(payload)
+                self.bytes_copied += len(payload)
+                received += len(payload)
+        return received, address
+
+    async def _first_peer(self) -> tuple:
+        """Wait for a peer to send to this socket, and set up a receiver for it"""
+        if self._on_new_peer is not None:
+            raise RuntimeError('already receiving')
+        first_peer = asyncio.get_running_loop().create_future()
+
+        def on_new_peer(address: tuple):
+            self._on_new_peer = None  # the first one only
+            self._add_receiver(address)
+            first_peer.set_result(address)
+
+        self._accept_peers(on_new_peer)
+        try:
+            return await first_peer
+        except asyncio.CancelledError:
+            if first_peer.done() and not first_peer.cancelled():  # cancelled right after the peer came
+                del self._receivers[first_peer.result()]
+                self._decoders.pop(first_peer.result()).clear()
+            raise
+        finally:
+            if self._on_new_peer is on_new_peer:
+                self._on_new_peer = None
+
+    async def aserve(self, handler: Callable[[bytearray, tuple], Awaitable[None]]):
+        """
+        Receive from any number of peers at a time, until cancelled
+
+        Every peer sending to this socket gets a receiver of its own, and handler(data, address)
+        is run for each message received, in a task of its own as well.
+        """
+        if self._on_new_peer is not None:
+            raise RuntimeError('already receiving')
+        tasks = set()
+
+        def on_new_peer(address: tuple):
+            self._add_receiver(address)
+            task = asyncio.ensure_future(self._serve_peer(address, handler))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        with self._watched():
+            self._accept_peers(on_new_peer)
+            try:
+                await asyncio.get_running_loop().create_future()  # which is never done
+            finally:
+                self._on_new_peer = None
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _add_receiver(self, address: tuple):
+        """Set up a receiver for a peer, keeping copies of its data to rebuild a segment lost from any group"""
+        self._receivers[address] = _Mailbox()
+        self._decoders[address] = _ParityDecoder(self._buffers)
+
+    def _accept_peers(self, on_new_peer: Callable[[tuple], None]):
+        """Have receivers set up for new peers, starting with those whose segments are read already"""
+        self._on_new_peer = on_new_peer
+        unclaimed, self._unclaimed = self._unclaimed, deque()
+        for data, address, buffer in unclaimed:
+            self._dispatch(data, address, buffer)
+
+    async def _serve_peer(self, address: tuple, handler: Callable[[bytearray, tuple], Awaitable[None]]):
+        try:
+            data = await self._receive(address)
+            await handler(data, address)
+        except ConnectionError:
+            logging.exception('Connection with %s:%d aborted', *address)
+
+    async def _receive(self, address: tuple) -> bytearray:
+        """Receive a whole message from a peer, whose receiver is set up already"""
         rcvd_data = bytearray()
+        async for payload in self._stream(address):
+            rcvd_data.extend(payload)
+            self.bytes_copied += len(payload)
+        return rcvd_data
+
+    async def _stream(self, address: tuple, idle_timeout: Optional[float]=IDLE_TIMEOUT) -> AsyncIterator[memoryview]:
+        """In-order payloads from a peer whose receiver is set up already, each valid until the next is asked for"""
+        try:
+            receive = self._sr_receive if self.selective_repeat else self._gbn_receive
+            payloads = receive(self._receivers[address], address, idle_timeout)
+            try:
+                async for payload in payloads:
+                    self.stats.bytes_delivered += len(payload)
+                    yield payload
+            finally:
+                await payloads.aclose()
+        finally:
+            del self._receivers[address]
+            self._decoders.pop(address).clear()
+            self._refused.pop(address, None)
+
+    async def asendto(self, data_to_send: 'Sendable', address: tuple):
+        """Coroutine version of sendto(), which may run along with transfers to other peers"""
+        if address in self._senders:
+            raise RuntimeError('already sending to {}'.format(address))
+        payloads = _Payloads(data_to_send, RDTSegment.MAX_PAYLOAD_LEN)
+        acks = self._senders[address] = _Mailbox()
+        # probe the latest version again, as a fallback may have been for a peer merely slow to reply,
+        # and the ACKs of a peer, in the version of the segments they acknowledge, would never tell
+        self._peer_versions.pop(address, None)
+        try:
+            with self._watched():
+                await self._finish(await self._send(payloads, address, acks), address, acks)
+        finally:
+            del self._senders[address]
+
+    async def _send(self, payloads: '_Payloads', address: tuple, acks: '_Mailbox') -> int:
+        if self.selective_repeat:
+            return await self._sr_sendto(payloads, address, acks)
+        return await self._gbn_sendto(payloads, address, acks)
+
+    async def _gbn_receive(self, segments: '_Mailbox', peer: tuple,
+                           idle_timeout: Optional[float]) -> AsyncIterator[memoryview]:
+        """Go-Back-N receiver, yielding payloads in order and acknowledging each once it is taken"""
         expected = 0
-        ack = RDTSegment(None, seq_num=0, ack_num=RDTSegment.SEQ_NUM_BOUND-1, ack=True)
-        # self.settimeout(socket.TIMEOUT)
-        timeout_count = -1
+        ack = RDTSegment(None, seq_num=0, ack_num=-1, ack=True, window=self.win_size)
         logging.info('ready to receive...')
         while True:
             try:
-                # segment_raw, remote_address = super().recvfrom(RDTSegment.SEGMENT_LEN)
-                segment_raw, remote_address = self._timeout_recvfrom(RDTSegment.SEGMENT_LEN)
-                logging.debug('received raw segment')
-                timeout_count = 0  # no timeout, reset
-                segment = RDTSegment.parse(segment_raw)
-                logging.info('expected: #%d, received: #%d', expected, segment.seq_num)
-                if segment.seq_num == expected:
-                    if not segment.fin:
-                        rcvd_data.extend(segment.payload)
-                    ack.ack_num = expected
-                    expected = (expected + 1) % RDTSegment.SEQ_NUM_BOUND
-                super().sendto(ack.encode(), remote_address)
-                if segment.fin:
-                    break
+                segment, buffer = await segments.get(idle_timeout)
             except TimeoutException:
-                if timeout_count < 0:
-                    continue
-                timeout_count += 1
-                logging.info('timed out, count=%d', timeout_count)
-                if timeout_count > socket.MAX_RETRY_TIMES:
-                    raise ConnectionAbortedError('timed out')
-            except ValueError:
-                super().sendto(ack.encode(), remote_address)
-
-        # self.setblocking(True)
-        logging.info('----------- receipt finished -----------')
-        return bytes(rcvd_data), remote_address
+                raise ConnectionAbortedError('timed out')
+            if segment is None:  # corrupted
+                self._buffers.release(buffer)
+                self._ack(ack, peer)
+                continue
+            bound = RDTSegment.SEQ_NUM_BOUNDS[segment.version]
+            logging.debug('expected: #%d, received: #%d', expected % bound, segment.seq_num)
+            if segment.seq_num == expected % bound:
+                if not segment.fin and segment.payload:
+                    if not self._room(peer, self.win_size):
+                        self._refuse(ack, peer, self.win_size)
+                        self._buffers.release(buffer)
+                        continue
+                    yield segment.payload
+                expected += 1
+            ack.version = segment.version  # reply in the version of the peer
+            ack.ack_num = (expected - 1) % bound
+            ack.window = self._room(peer, self.win_size)
+            self._buffers.release(buffer)
+            self._ack(ack, peer, delay=not segment.fin)
+            if segment.fin:
+                self._linger(peer, ack)
+                break
 
+        logging.info('----------- receipt finished -----------')
 
-    def sendto(self, data_to_send: bytes, address: tuple):
-        total_len = len(data_to_send)
-        UNIT = RDTSegment.MAX_PAYLOAD_LEN
+    async def _gbn_sendto(self, payloads: '_Payloads', address: tuple, acks: '_Mailbox') -> int:
+        """Go-Back-N sender, returning the index following the last segment once all are acknowledged"""
+        path = self._path(address)
+        rtt, fec = path.rtt_estimator, path.fec
+        congestion = path.congestion = CongestionController(max_window=RDTSegment.MAX_WINDOW)
 
-        base = 0  # to be acked
-        next = 0
-        win = deque(maxlen=socket.WIN_SIZE)
+        base = payloads.first  # to be acked
+        next = base  # to be sent, which goes back to base on losses
+        sent_end = base  # one past the highest index ever sent
+        sent_at = {}  # index -> time of the first transmission, for segments never retransmitted
+        deadline = None  # of the retransmission timer, which runs while any segment is in flight
+        dup_acks = 0
+        dup_ack_threshold = CongestionController.DUP_ACK_THRESHOLD
+        peer_window = socket.WIN_SIZE
+        unanswered = 0  # timeouts before anything is heard from the peer, None since then
+        parity = _ParityEncoder(fec, base) if fec is not None else None
         logging.info('ready to send...')
 
         # Send data
-        timeout_count = 0
-        while base * UNIT < total_len:
-            # enqueue
-            while next < base + socket.WIN_SIZE:
-                # logging.debug('next=%d', next)
-                if next * UNIT > total_len:
-                    break
-                # FIXME: meaningless ack_num (since full duplex transmission is not supported yet)
-                pkt = RDTSegment(data_to_send[next*UNIT:next*UNIT+UNIT], seq_num=next, ack_num=0)
-                win.append(pkt)
+        backoffs = 0  # timeouts since the peer was last heard from
+        while payloads.has(base):
+            # send as many segments as both the congestion window and the peer's window allow
+            # (at least one, so that a closed peer window is probed), as long as sequence numbers are not reused
+            window = max(min(congestion.window, peer_window, self._seq_num_bound(address) - 1), 1)
+            while next < base + window and payloads.has(next):
+                self._send_data(payloads, next, address, more=True)
+                if next == sent_end:
+                    sent_at[next] = monotonic()
+                    sent_end += 1
+                    if parity is not None:
+                        self._send_parity(parity.add(next, payloads.get(next)), address)
+                else:
+                    self.stats.retransmits += 1
+                if deadline is None:
+                    deadline = monotonic() + rtt.rto
                 next += 1
-
-            # send all segments in the window
-            for pkt in win:
-                super().sendto(pkt.encode(), address)
-                logging.debug('sent #%d', pkt.seq_num)
+            if parity is not None and next == sent_end and not payloads.has(next):  # nothing more to send for now
+                self._send_parity(parity.flush(), address)
+            self._flush()
 
             # handle acknowledgements
-            # self.settimeout(socket.TIMEOUT)
-            while True:
-                try:
-                    # assumption: no truncated packets
-                    # data, remote_address = super().recvfrom(RDTSegment.SEGMENT_LEN)
-                    data, remote_address = self._timeout_recvfrom(RDTSegment.SEGMENT_LEN)
-                    assert remote_address == address
-                    rcvd_ack = RDTSegment.parse(data)
-                    timeout_count = 0  # no error, reset counter
-
-                    assert rcvd_ack.ack
-                    logging.info('#%d acked', rcvd_ack.ack_num)
-                    # cumulative ack
-                    assert ((win[0].seq_num <= rcvd_ack.ack_num <= win[-1].seq_num) or
-                            (win[0].seq_num > win[-1].seq_num and (rcvd_ack.ack_num <= win[-1].seq_num or
-                                                                   rcvd_ack.ack_num >= win[0].seq_num)))
-                    while True:
-                        front = win.popleft().seq_num
-                        base += 1
-                        logging.debug('base=%d', base)
-                        if front == rcvd_ack.ack_num:
-                            break
-                    logging.debug('win.length = %d', len(win))
+            try:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutException
+                rcvd_ack = await acks.get(remaining)
+                if rcvd_ack is None:  # more data to send
+                    continue
+                backoffs = 0
+                unanswered = None
+                # an ACK piggybacked on data or a FIN, updating the window or closing it, is not a duplicate (RFC 5681)
+                duplicate = not (rcvd_ack.payload or rcvd_ack.fin or rcvd_ack.window not in (None, peer_window))
+                if rcvd_ack.window is not None:
+                    peer_window = rcvd_ack.window
+                bound = RDTSegment.SEQ_NUM_BOUNDS[rcvd_ack.version]
+                offset = (rcvd_ack.ack_num - base) % bound
+                if offset == bound - 1 and (not duplicate or peer_window == 0):
+                    continue
+                if offset == bound - 1:  # duplicate ack of base - 1
+                    dup_acks += 1
+                    self.stats.duplicate_acks += 1
+                    if dup_acks == 1:
+                        dup_ack_threshold = self._dup_ack_threshold(parity)
+                    if dup_acks == dup_ack_threshold:
+                        logging.debug('fast retransmit from #%d', base)
+                        self.stats.fast_retransmits += 1
+                        congestion.on_fast_retransmit(sent_end - base)
+                        if parity is not None:
+                            fec.on_loss()
+                        next = base  # go back N
+                        sent_at.clear()
+                        deadline = monotonic() + rtt.rto
+                    continue
+                # cumulative ack, which may also cover segments sent before going back
+                assert offset < sent_end - base
+            except AssertionError:
+                logging.debug('unexpected segment received')
+                continue
+            except TimeoutException:
+                logging.debug('timed out, rto=%.3f', rtt.rto)
+                self.stats.timeouts += 1
+                backoffs += 1
+                if backoffs > socket.MAX_BACKOFFS:
+                    raise ConnectionError('timed out')
+                if unanswered is not None:
+                    unanswered += 1
+                    if unanswered == socket.FALLBACK_TIMEOUTS:
+                        self._fall_back(address)
+                rtt.backoff()
+                congestion.on_timeout(sent_end - base)
+                if parity is not None:
+                    fec.on_loss()
+                next = base  # go back N
+                sent_at.clear()
+                deadline = monotonic() + rtt.rto
+                dup_acks = 0
+                continue
 
-                    # all acked
-                    if len(win) == 0:  # or, if base == next
-                        break
-                except ValueError:
-                    logging.info('corrupted ack, ignored')
-                except AssertionError:
-                    logging.info('duplicate ack or unexpected segment received')
-                except TimeoutException:
-                    timeout_count += 1
-                    logging.info('timed out, count=%d', timeout_count)
-                    if timeout_count > socket.MAX_RETRY_TIMES:
-                        raise ConnectionError('timed out')
-                    break
+            logging.debug('#%d acked', rcvd_ack.ack_num)
+            acked = offset + 1
+            first_sent = sent_at.get(base + offset)
+            for index in range(base, base + acked):
+                sent_at.pop(index, None)
+                self.stats.bytes_acked += len(payloads.get(index))
+            if first_sent is not None:  # Karn's algorithm: no samples from retransmitted segments
+                rtt.sample(monotonic() - first_sent)
+                self.stats.record_rtt(monotonic() - first_sent)
+            else:
+                rtt.reset_backoff()
+            congestion.on_ack(acked)
+            if parity is not None:
+                if dup_acks and first_sent is not None:  # rebuilt from parity (or reordered)
+                    fec.on_loss()
+                fec.on_delivered(acked)
+            base += acked
+            payloads.release(base)
+            next = max(next, base)
+            dup_acks = 0
+            deadline = monotonic() + rtt.rto if base < next else None
 
-        # Finish
-        fin_seq = next % RDTSegment.SEQ_NUM_BOUND
-        fin_pkt = RDTSegment(None, seq_num=fin_seq, ack_num=0, fin=True).encode()  # FIXME: meaningless ack_num
+        return next
+
+    async def _finish(self, fin_index: int, address: tuple, acks: '_Mailbox'):
+        rtt = self._path(address).rtt_estimator
         fin_err_count = 0
+        self._transmit(self._segment(None, fin_index, address, fin=True), address)
+        deadline = monotonic() + rtt.rto
         while True:
             try:
-                super().sendto(fin_pkt, address)
-                # data, remote_address = super().recvfrom(RDTSegment.SEGMENT_LEN)
-                data, remote_address = self._timeout_recvfrom(RDTSegment.SEGMENT_LEN)
+                # ACKs of anything else, such as those piggybacked on the data of the peer, are waited past
+                rcvd_ack = await acks.get(max(deadline - monotonic(), 0))
 
                 # limited by the required APIs to provide, the receipt of the last FINACK
                 # is not guaranteed, though a high probability is provided
-                rcvd_ack = RDTSegment.parse(data)
-                if rcvd_ack.ack and rcvd_ack.ack_num == fin_seq:
+                if rcvd_ack is not None and rcvd_ack.ack_num == fin_index % RDTSegment.SEQ_NUM_BOUNDS[rcvd_ack.version]:
                     break
-            except (TimeoutException, ValueError):
+            except TimeoutException:
+                self.stats.timeouts += 1
                 fin_err_count += 1
                 if fin_err_count > socket.MAX_RETRY_TIMES:
                     break
-        # self.setblocking(True)
+                rtt.backoff()
+                self._transmit(self._segment(None, fin_index, address, fin=True), address)
+                deadline = monotonic() + rtt.rto
         logging.info('----------- all sent -----------')
 
-    def _timeout_recvfrom(self, buffer_size, timeout=TIMEOUT):
-        # This implementation uses SIGALRM signal to set timeout for recvfrom(),
-        # and consequently it is incompatible with Windows.
-        #
-        # Note that socket.settimeout() can provide better compatibility
-        # if we do not need to care about time.sleep()
-        signal.setitimer(signal.ITIMER_REAL, timeout)
-        ans = super().recvfrom(buffer_size)
-        signal.setitimer(signal.ITIMER_REAL, 0)
-        return ans
+    async def _sr_receive(self, segments: '_Mailbox', peer: tuple,
+                          idle_timeout: Optional[float]) -> AsyncIterator[memoryview]:
+        """Selective Repeat receiver: buffer out-of-order segments and acknowledge each one individually"""
+        expected = 0  # index of the first segment not yet delivered
+        rcv_buffer = {}  # index -> (payload, the buffer holding it), for segments received out of order
+        logging.info('ready to receive (selective repeat)...')
+        while True:
+            try:
+                segment, buffer = await segments.get(idle_timeout)
+            except TimeoutException:
+                raise ConnectionAbortedError('timed out')
+            if segment is None:
+                logging.debug('corrupted segment, ignored')
+                self._buffers.release(buffer)
+                continue
+
+            bound = RDTSegment.SEQ_NUM_BOUNDS[segment.version]
+            window = min(self.win_size, bound // 2)
+            offset = (segment.seq_num - expected) % bound
+            if offset < window and not segment.fin:  # inside the receiving window
+                logging.debug('expected: #%d, received: #%d', expected % bound, segment.seq_num)
+                if expected + offset in rcv_buffer:  # duplicate
+                    self._buffers.release(buffer)
+                elif offset < window and not self._room(peer, self.win_size):
+                    # acknowledging the one before, which the sender takes for a duplicate
+                    last = RDTSegment(None, seq_num=0, ack_num=(expected - 1) % bound, ack=True,
+                                      version=segment.version)
+                    self._refuse(last, peer, window - len(rcv_buffer))
+                    self._buffers.release(buffer)
+                    continue
+                else:
+                    rcv_buffer[expected + offset] = (segment.payload, buffer)  # kept until delivered
+                while expected in rcv_buffer:
+                    payload, buffer = rcv_buffer.pop(expected)
+                    if payload:
+                        yield payload
+                    self._buffers.release(buffer)
+                    expected += 1
+            else:
+                self._buffers.release(buffer)
+                if offset < window:  # FIN
+                    if offset != 0:  # FIN is only sent after all data are acked
+                        continue
+                    fin_ack = self._sr_ack(segment, self._room(peer, window - len(rcv_buffer)))
+                    self._ack(fin_ack, peer, delay=False)
+                    self._linger(peer, fin_ack)
+                    break
+                if offset < bound - window:  # neither in the current window nor the previous one
+                    continue
+            # acknowledge the very segment, including those delivered already (their ACKs may be lost)
+            self._ack(self._sr_ack(segment, self._room(peer, window - len(rcv_buffer))), peer)
+
+        logging.info('----------- receipt finished -----------')
+
+    @staticmethod
+    def _sr_ack(segment: 'RDTSegment', room: int) -> 'RDTSegment':
+        """Selective ACK of a segment, advertising the room left in the reordering buffer"""
+        return RDTSegment(None, seq_num=0, ack_num=segment.seq_num, ack=True, window=room, version=segment.version)
+
+    async def _sr_sendto(self, payloads: '_Payloads', address: tuple, acks: '_Mailbox') -> int:
+        """Selective Repeat sender: one timer per segment in the window, retransmitting only expired ones"""
+        path = self._path(address)
+        rtt, fec = path.rtt_estimator, path.fec
+        congestion = path.congestion = CongestionController(max_window=RDTSegment.MAX_WINDOW)
+
+        base = payloads.first  # index of the first unacknowledged segment
+        next = base
+        deadlines = {}  # index -> time to retransmit, for every unacknowledged segment in the window
+        timers = []  # heap of (time to retransmit, index), with entries no longer in deadlines skipped
+        sent_at = {}  # index -> time of the first transmission, for segments never retransmitted
+        acked = set()
+        acked_above_base = 0  # ACKs of later segments while base is missing, which count as duplicate ACKs
+        dup_ack_threshold = CongestionController.DUP_ACK_THRESHOLD
+        peer_window = socket.WIN_SIZE
+        unanswered = 0  # timeouts before anything is heard from the peer, None since then
+        parity = _ParityEncoder(fec, base) if fec is not None else None
+        backoffs = 0  # timeouts of base since the peer was last heard from
+        logging.info('ready to send (selective repeat)...')
+
+        while payloads.has(base):
+            # send new segments as the window slides (at least one, so that a closed peer window is probed),
+            # with the window at most half the sequence number space, as the receiver's is
+            window = max(min(congestion.window, peer_window, self._seq_num_bound(address) // 2), 1)
+            while next < base + window and payloads.has(next):
+                self._send_data(payloads, next, address, more=True)
+                sent_at[next] = monotonic()
+                self._sr_arm(deadlines, timers, next, sent_at[next] + rtt.rto)
+                if parity is not None:
+                    self._send_parity(parity.add(next, payloads.get(next)), address)
+                next += 1
+            if parity is not None and not payloads.has(next):  # nothing more to send for now
+                self._send_parity(parity.flush(), address)
+            self._flush()
+
+            # wait for ACKs until the earliest timer expires
+            while deadlines.get(timers[0][1]) != timers[0][0]:
+                heapq.heappop(timers)
+            index = timers[0][1]
+            remaining = deadlines[index] - monotonic()
+            try:
+                if remaining <= 0:
+                    raise TimeoutException
+                rcvd_ack = await acks.get(remaining)
+                if rcvd_ack is None:  # more data to send
+                    continue
+                backoffs = 0
+                unanswered = None
+                # an ACK piggybacked on data or a FIN, updating the window or closing it, is not a duplicate (RFC 5681)
+                duplicate = not (rcvd_ack.payload or rcvd_ack.fin or rcvd_ack.window not in (None, peer_window))
+                if rcvd_ack.window is not None:
+                    peer_window = rcvd_ack.window
+                bound = RDTSegment.SEQ_NUM_BOUNDS[rcvd_ack.version]
+                offset = (rcvd_ack.ack_num - base) % bound
+                if offset == bound - 1 and (not duplicate or peer_window == 0):
+                    continue
+                assert offset < next - base  # inside the sending window
+            except AssertionError:
+                logging.debug('duplicate ack or unexpected segment received')
+                self.stats.duplicate_acks += 1
+                continue
+            except TimeoutException:
+                logging.debug('#%d timed out, rto=%.3f', index, rtt.rto)
+                self.stats.timeouts += 1
+                if index == base:  # back off once per loss event, as the single timer of RFC 6298 does
+                    backoffs += 1
+                    if backoffs > socket.MAX_BACKOFFS:
+                        raise ConnectionError('timed out')
+                    if unanswered is not None:
+                        unanswered += 1
+                        if unanswered == socket.FALLBACK_TIMEOUTS:
+                            self._fall_back(address)
+                    rtt.backoff()
+                    congestion.on_timeout(next - base)
+                if parity is not None:
+                    fec.on_loss()
+                self._send_data(payloads, index, address)
+                self.stats.retransmits += 1
+                sent_at.pop(index, None)
+                self._sr_arm(deadlines, timers, index, monotonic() + rtt.rto)
+                continue
+
+            logging.debug('#%d acked', rcvd_ack.ack_num)
+            index = base + offset
+            if index not in deadlines:
+                if duplicate:
+                    self.stats.duplicate_acks += 1
+                continue
+            del deadlines[index]
+            self.stats.bytes_acked += len(payloads.get(index))
+            acked.add(index)
+            congestion.on_ack(1)
+            if parity is not None:
+                if index == base and acked_above_base and index in sent_at:  # rebuilt from parity (or reordered)
+                    fec.on_loss()
+                fec.on_delivered(1)
+            if index in sent_at:  # Karn's algorithm: no samples from retransmitted segments
+                sample = monotonic() - sent_at.pop(index)
+                rtt.sample(sample)
+                self.stats.record_rtt(sample)
+            else:
+                rtt.reset_backoff()
+            if index == base:
+                while base in acked:
+                    acked.remove(base)
+                    base += 1
+                payloads.release(base)
+                # segments acknowledged past the new base, missing if there are any, count as duplicate ACKs for it
+                acked_above_base = len(acked)
+                if acked_above_base:
+                    dup_ack_threshold = self._dup_ack_threshold(parity)
+                if acked_above_base < dup_ack_threshold or base not in sent_at:  # or retransmitted already
+                    continue
+            else:
+                acked_above_base += 1
+                if acked_above_base == 1:
+                    dup_ack_threshold = self._dup_ack_threshold(parity)
+                if acked_above_base != dup_ack_threshold:
+                    continue
+            logging.debug('fast retransmit #%d', base)
+            self.stats.fast_retransmits += 1
+            self.stats.retransmits += 1
+            congestion.on_fast_retransmit(next - base)
+            if parity is not None:
+                fec.on_loss()
+            self._send_data(payloads, base, address)
+            sent_at.pop(base, None)
+            self._sr_arm(deadlines, timers, base, monotonic() + rtt.rto)
+
+        return next
+
+    @staticmethod
+    def _sr_arm(deadlines: Dict[int, float], timers: List[Tuple[float, int]], index: int, deadline: float):
+        """(Re)start the timer of a segment, superseding any entry of it left in the heap"""
+        deadlines[index] = deadline
+        heapq.heappush(timers, (deadline, index))
+
+    def _send_data(self, payloads: '_Payloads', index: int, address: tuple, more: bool=False):
+        """Send the index-th segment of the data"""
+        pkt = self._segment(payloads.get(index), index, address)
+        self._transmit(pkt, address, more)
+        logging.debug('sent #%d', pkt.seq_num)
+
+    def _segment(self, payload: Optional[memoryview], seq_num: int, address: tuple, fin: bool=False) -> 'RDTSegment':
+        """
+        A data segment or a FIN to a peer, which on a connection carries the latest ACK to it, the one held if any,
+        so that the ACK gets through as long as any segment does, retransmissions included
+        """
+        held = self._held_acks.pop(address, None)
+        if held is not None:
+            held[1].cancel()
+        ack = self._last_acks.get(address)
+        if ack is None:  # nothing to acknowledge, with ack_num meaningless
+            return RDTSegment(payload, seq_num=seq_num, ack_num=0, fin=fin,
+                              version=self._peer_versions.get(address, RDTSegment.VERSION))
+        return RDTSegment(payload, seq_num=seq_num, ack_num=ack.ack_num, fin=fin, ack=True, window=ack.window,
+                          version=ack.version)
+
+    def _send_parity(self, parity: Optional['RDTSegment'], address: tuple):
+        """Send a parity segment, if any, to a peer speaking the latest version (the others do not understand it)"""
+        if parity is not None and self._peer_versions.get(address, RDTSegment.VERSION) == RDTSegment.VERSION:
+            self._transmit(parity, address, more=True)
+            logging.debug('sent parity of #%d-#%d', parity.seq_num, parity.seq_num + parity.window - 1)
+
+    @staticmethod
+    def _dup_ack_threshold(parity: Optional['_ParityEncoder']) -> int:
+        """Duplicate ACKs taken for a loss, more of which are expected while the parity to rebuild it is on the way"""
+        if parity is None:
+            return CongestionController.DUP_ACK_THRESHOLD
+        return CongestionController.DUP_ACK_THRESHOLD + parity.group_size
+
+    def _ack(self, ack: 'RDTSegment', peer: tuple, delay: bool=True):
+        """
+        Send an ACK, which on a connection is held for up to ACK_DELAY seconds to be piggybacked on data,
+        unless more segments from the peer are queued already (the ACK held before is sent first anyway),
+        in which case it is sent in a batch with the ACKs of those
+        """
+        self._flush_ack(peer)
+        if peer in self._last_acks:
+            self._last_acks[peer] = RDTSegment(None, seq_num=0, ack_num=ack.ack_num, ack=True, window=ack.window,
+                                               version=ack.version)
+        more = bool(self._receivers.get(peer))
+        if delay and peer in self._connections and not more:
+            timer = asyncio.get_running_loop().call_later(socket.ACK_DELAY, self._flush_ack, peer)
+            self._held_acks[peer] = (self._last_acks[peer], timer)
+        else:
+            self._transmit(ack, peer, more)
+
+    def _flush_ack(self, peer: tuple):
+        """Send the ACK held for a peer, if any"""
+        held = self._held_acks.pop(peer, None)
+        if held is not None:
+            ack, timer = held
+            timer.cancel()
+            self._transmit(ack, peer)
+
+    def _path(self, address: tuple) -> '_Path':
+        """State of the transfers with a peer, that of the least recent peer being dropped beyond MAX_PATHS"""
+        path = self._paths.pop(address, None)
+        if path is None:
+            path = _Path(self.fec)
+            if len(self._paths) >= socket.MAX_PATHS:
+                del self._paths[next(iter(self._paths))]
+        self._paths[address] = self._latest_path = path
+        return path
+
+    def _seq_num_bound(self, address: tuple) -> int:
+        """
+        Bound of the sequence numbers in the version spoken to a peer, which windows are kept below for Go-Back-N
+        and within half of for Selective Repeat
+        """
+        return RDTSegment.SEQ_NUM_BOUNDS[self._peer_versions.get(address, RDTSegment.VERSION)]
+
+    def _room(self, peer: tuple, window: int) -> int:
+        """The window to advertise to a peer, less the segments received on the connection with it and not read yet"""
+        connection = self._connections.get(peer)
+        if connection is None:
+            return window
+        return max(window - -(-connection.unread // RDTSegment.MAX_PAYLOAD_LEN), 0)
+
+    def _refuse(self, ack: 'RDTSegment', peer: tuple, window: int):
+        """
+        Drop a segment for want of room, telling the peer its window is closed with an ACK of what came before it,
+        sent again with the window reopened once the application reads (see _update_window())
+        """
+        refused = RDTSegment(None, seq_num=0, ack_num=ack.ack_num, ack=True, window=0, version=ack.version)
+        self._refused[peer] = (refused, window)
+        self._ack(refused, peer, delay=False)
+
+    def _update_window(self, peer: tuple):
+        """Reopen the window closed to a peer, if any, as soon as there is room again, rather than when it probes"""
+        refused = self._refused.get(peer)
+        if refused is None:
+            return
+        ack, window = refused
+        room = self._room(peer, window)
+        if room:
+            del self._refused[peer]
+            self._ack(RDTSegment(None, seq_num=0, ack_num=ack.ack_num, ack=True, window=room, version=ack.version),
+                      peer, delay=False)
+
+    def _fall_back(self, address: tuple):
+        """
+        Speak the oldest version to a peer that never replies, in case it drops what it cannot parse,
+        for the rest of the transfer; a peer connected has spoken the latest one in the handshake
+        """
+        if address not in self._connections and self._peer_versions.get(address, RDTSegment.VERSION) != 1:
+            logging.info('no reply from %s:%d, falling back to version 1', *address)
+            self._peer_versions[address] = 1
+
+    def _transmit(self, segment: 'RDTSegment', address: tuple, more: bool=False):
+        """
+        Send a segment, along with those in the batch to send
+
+        :param more: whether more segments are to follow at once, in which case it is added to the batch,
+                     sent once it is full, by a call without `more`, or else at the end of the iteration of the loop
+        """
+        length = segment.encoded_len()
+        if self._batch_count and (address != self._batch_address or length > self._batch_unit
+                                  or self._batch_len % self._batch_unit  # a shorter one is the last already
+                                  or self._batch_len + length > len(self._send_buffer)):
+            self._flush()
+        if not self._batch_count:
+            self._batch_address = address
+            self._batch_unit = length
+        self._batch_len += segment.encode_into(self._send_buffer, self._batch_len)
+        self._batch_count += 1
+        self.stats.segments_sent += 1
+        self.stats.bytes_sent += length
+        self.bytes_copied += length - RDTSegment.HEADER_FORMATS[segment.version].size
+        if not more or self._batch_count >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            try:
+                self._flush_handle = asyncio.get_running_loop().call_soon(self._flush_batch)
+            except RuntimeError:  # no event loop to flush it
+                self._flush()
+
+    def _flush_batch(self):
+        self._flush_handle = None
+        self._flush()
+
+    def _flush(self):
+        """
+        Send the batch without blocking, with what the send buffer has no room for left until it has
+
+        On Linux, the batch goes in a single system call, cut into datagrams by the kernel (UDP segmentation
+        offload), its segments being of the same length but for a shorter last one; elsewhere, one call per segment.
+        """
+        if not self._batch_count or self.fileno() == -1:
+            self._batch_len = self._batch_count = 0
+            return
+        batch = memoryview(self._send_buffer)[:self._batch_len]
+        unit, address = self._batch_unit, self._batch_address
+        self._batch_len = self._batch_count = 0
+        sent = self._send_batch(batch, unit, address) if not self._unsent else 0  # in order after those left
+        if sent < len(batch):
+            self._leave_unsent(batch[sent:], unit, address)
+
+    def _send_batch(self, batch: memoryview, unit: int, address: tuple) -> int:
+        """Send segments of `unit` bytes but for a shorter last one, returning the bytes sent before the buffer fills"""
+        if len(batch) > unit and self._segmentation:
+            try:
+                self.sendmsg([batch], [(IPPROTO_UDP, UDP_SEGMENT, struct.pack('=H', unit))], 0, address)
+                return len(batch)
+            except BlockingIOError:
+                return 0
+            except OSError:  # not supported by the kernel
+                logging.info('UDP segmentation offload unavailable')
+                self._segmentation = False
+        for start in range(0, len(batch), unit):
+            try:
+                super().sendto(batch[start:start+unit], address)
+            except BlockingIOError:
+                return start
+        return len(batch)
+
+    def _leave_unsent(self, segments: memoryview, unit: int, address: tuple):
+        """Keep segments the send buffer has no room for, to send them once it has, unless too many are left already"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # no event loop to wait in
+            loop = None
+        if loop is None or len(self._unsent) >= self.max_batch:
+            logging.debug('send buffer full, segments dropped')
+            return
+        if loop is not self._writing_loop:  # the first batch left, or those before were left in a loop closed since
+            if self._writing_loop is not None:
+                self._writing_loop.remove_writer(self.fileno())
+            loop.add_writer(self.fileno(), self._on_writable)
+            self._writing_loop = loop
+        logging.debug('send buffer full, segments left until it has room')
+        self._unsent.append((bytes(segments), unit, address))
+
+    def _on_writable(self):
+        """Send the batches left, in order, for as long as the send buffer has room"""
+        while self._unsent:
+            segments, unit, address = self._unsent[0]
+            sent = self._send_batch(memoryview(segments), unit, address)
+            if sent < len(segments):
+                self._unsent[0] = (segments[sent:], unit, address)
+                return
+            self._unsent.popleft()
+        self._stop_writing()
+
+    def _stop_writing(self):
+        """Stop watching for room in the send buffer, dropping the batches left if any"""
+        if self._writing_loop is not None:
+            self._writing_loop.remove_writer(self.fileno())
+            self._writing_loop = None
+        self._unsent.clear()
+
+    @contextmanager
+    def _watched(self):
+        """Let the running event loop read the socket while any transfer is in progress, or any peer lingers"""
+        loop = asyncio.get_running_loop()
+        if self._transfers == 0:
+            self._stop_reading()
+            loop.add_reader(self.fileno(), self._on_readable, loop)
+            self._reading_loop = loop
+            self.stats.start_clock()
+            if self.stats_interval:
+                self._stats_timer = loop.call_later(self.stats_interval, self._log_stats, loop)
+        self._transfers += 1
+        try:
+            yield
+        finally:
+            self._transfers -= 1
+            if self._transfers == 0:
+                self._linger_reading()
+                self.stats.stop_clock()
+                if self._stats_timer is not None:
+                    self._stats_timer.cancel()
+                    self._stats_timer = None
+
+    def _linger_reading(self):
+        """Stop reading the socket, though not before the peers lingering are done retransmitting their FINs"""
+        self._reading_timer = None
+        until = max((until for until, _ in self._lingering.values()), default=0.)
+        if until > monotonic():
+            self._reading_timer = self._reading_loop.call_later(until - monotonic(), self._linger_reading)
+        else:
+            self._stop_reading()
+
+    def _stop_reading(self):
+        """Stop reading the socket, if it is read at all"""
+        if self._reading_timer is not None:
+            self._reading_timer.cancel()
+            self._reading_timer = None
+        if self._reading_loop is not None:
+            if not self._reading_loop.is_closed():
+                self._reading_loop.remove_reader(self.fileno())
+            self._reading_loop = None
+
+    def _log_stats(self, loop: asyncio.AbstractEventLoop, last_counts: Tuple[int, int]=(0, 0)):
+        """Log a summary of the stats, unless no segment is sent or received since the last one"""
+        counts = (self.stats.segments_sent, self.stats.segments_received)
+        if counts != last_counts:
+            logging.info('%s', self.stats.summary())
+        self._stats_timer = loop.call_later(self.stats_interval, self._log_stats, loop, counts)
+
+    def _on_readable(self, loop: asyncio.AbstractEventLoop):
+        """Read the datagrams pending, up to a batch of them"""
+        for _ in range(self.max_batch):
+            buffer = self._buffers.acquire()
+            try:
+                # UDPsocket.recvfrom() is bypassed, as its emulated delays would block the whole event loop
+                length, address = self.recvfrom_into(buffer)
+            except BlockingIOError:
+                self._buffers.release(buffer)
+                return
+            self.stats.segments_received += 1
+            data, delay = self._emulate(memoryview(buffer)[:length])
+            if data is None:
+                self._buffers.release(buffer)
+            elif delay:
+                loop.call_later(delay, self._dispatch, data, address, buffer)
+            else:
+                self._dispatch(data, address, buffer)
+
+    def _dispatch(self, data: memoryview, address: tuple, buffer: bytearray):
+        """
+        Route a received datagram to the transfer it belongs to, or drop it if there is none
+
+        Receivers get the buffer of the datagram along with the segment, and give it back to the pool
+        once its payload is delivered.
+        """
+        try:
+            segment = RDTSegment.parse(data)
+        except ValueError:
+            segment = None  # corrupted, which only receivers reply to
+            self.stats.corrupted += 1
+        else:
+            self._peer_versions[address] = segment.version
+            if segment.parity:
+                if address in self._receivers:
+                    self._rebuild(segment, address)
+                self._buffers.release(buffer)
+                return
+            if segment.syn:
+                self._handshake(segment, address)
+                self._buffers.release(buffer)
+                return
+            if segment.ack:
+                connection = self._connections.get(address)
+                # ACKs come with every segment on a connection, and are queued up only while anything waits for them
+                if address in self._senders and (connection is None or connection.awaiting_acks):
+                    self._senders[address].put(segment)  # which refers to the buffer for nothing but the payload
+                if not segment.payload and not segment.fin:  # nothing but an ACK, rather than piggybacked
+                    self._buffers.release(buffer)
+                    return
+        if address in self._receivers:
+            self._deliver(segment, address, buffer)
+            return
+        elif address in self._lingering and monotonic() < self._lingering[address][0]:
+            if segment is not None and segment.fin:  # the FINACK is lost
+                self._transmit(self._lingering[address][1], address)
+        elif self._on_new_peer is not None and segment is not None and not (segment.fin and segment.seq_num):
+            # a FIN alone is an empty message, unless it follows data, which makes it a late retransmission
+            self._on_new_peer(address)
+            self._deliver(segment, address, buffer)
+            return
+        elif segment is not None and not segment.ack and not (segment.fin and segment.seq_num) \
+                and len(self._unclaimed) < self.max_batch:
+            # read along with others, though it would have been left to a later recvfrom() in the kernel
+            self._unclaimed.append((data, address, buffer))
+            return
+        self._buffers.release(buffer)
+
+    def _deliver(self, segment: Optional['RDTSegment'], address: tuple, buffer: bytearray):
+        """Pass a segment on to the receiver of its peer, with its payload kept for parity to rebuild others"""
+        if segment is not None and not segment.fin:
+            self._decoders[address].add(segment, buffer)
+        self._receivers[address].put((segment, buffer))
+
+    def _rebuild(self, parity: 'RDTSegment', address: tuple):
+        """Pass the segment rebuilt from a parity segment, if any, on to the receiver, as if it were received"""
+        rebuilt = self._decoders[address].recover(parity)
+        if self.selective_repeat:  # which has kept those received after it
+            rebuilt = rebuilt[:1]
+        for seq_num, payload in rebuilt:
+            buffer = self._buffers.acquire()
+            buffer[:len(payload)] = payload
+            self.bytes_copied += len(payload)
+            segment = RDTSegment(memoryview(buffer)[:len(payload)], seq_num=seq_num, ack_num=0, version=parity.version)
+            self._receivers[address].put((segment, buffer))
+        if rebuilt:
+            logging.debug('#%d rebuilt from parity', rebuilt[0][0])
+            self.stats.rebuilt += 1
+
+    def _handshake(self, segment: 'RDTSegment', address: tuple):
+        """Answer a SYN from a peer connecting to this socket, or pass a SYN-ACK on to connect()"""
+        if segment.ack:
+            if address in self._connecting:
+                self._connecting[address].put(segment)
+            return
+        if address in self._connections:  # the SYN-ACK is lost
+            pass
+        elif self._backlog is None or len(self._backlog) >= self._backlog_size:
+            return  # to be retransmitted by the peer
+        elif address in self._lingering and monotonic() < self._lingering[address][0]:
+            return  # late retransmission of the SYN of a connection closed just now
+        else:
+            self._backlog.put(Connection(self, address))
+        self._transmit(RDTSegment(None, seq_num=0, ack_num=0, syn=True, ack=True, window=self.win_size), address)
+
+    def _linger(self, peer: tuple, fin_ack: 'RDTSegment'):
+        """Keep the FINACK to a peer for LINGER seconds, for late segments not to be taken for a new transfer"""
+        now = monotonic()
+        for address in [a for a, (until, _) in self._lingering.items() if until <= now]:
+            del self._lingering[address]
+        self._lingering[peer] = (now + socket.LINGER, fin_ack)
 
     def close(self):
-        # not necessary for connectionless RDT
-        raise NotImplementedError
+        if self._connection is not None:
+            self._connection.close()
+        if self._transfers:
+            raise RuntimeError('transfers in progress')
+        self._flush()
+        self._stop_writing()
+        self._stop_reading()
+        if self._loop is not None:
+            self._loop.close()
+        super().close()
+
+    async def aclose(self):
+        """Coroutine version of close()"""
+        if self._connection is not None:
+            await self._connection.aclose()
+        if self._transfers:
+            raise RuntimeError('transfers in progress')
+        self._flush()
+        self._stop_writing()
+        self._stop_reading()
+        super().close()
+
+
+Sendable = Union[bytes, bytearray, memoryview, BinaryIO, Iterable[bytes]]
+
+
+class Connection:
+    """
+    Full-Duplex Reliable Data Transfer Connection with a peer, made by socket.connect() or socket.accept()
+
+    Connections are set up by a SYN handshake: the peer connecting sends SYNs until a SYN-ACK comes back,
+    the SYN-ACK being acknowledged by whatever it sends next. Either direction is then a stream of its own,
+    with the data of send() calls queued for one sender after another, until close() sends a FIN.
+
+    ACKs of data received are held for up to socket.ACK_DELAY seconds, to be piggybacked on the data sent
+    in the meantime (those of request/response exchanges, above all), saving segments of their own. As send()
+    returns once its data are sent, rather than acknowledged, an ACK held by the peer holds up no application.
+    Every data segment and FIN sent carries the latest ACK, retransmissions included, lest the loss of the one
+    an ACK was piggybacked on leave the peer waiting for it.
+
+    Data received and not yet read take up the window advertised to the peer, so that at most `win_size`
+    segments of them are held: beyond that, segments are dropped until recv() makes room again.
+    """
+
+    def __init__(self, sock: socket, peer: tuple):
+        self.socket = sock
+        self.peer = peer
+        self._acks = sock._senders[peer] = _Mailbox()  # and None for more data to send
+        sock._add_receiver(peer)
+        sock._connections[peer] = self
+        sock._last_acks[peer] = RDTSegment(None, seq_num=0, ack_num=-1, ack=True, window=sock.win_size)  # of nothing
+        self._outgoing = _Payloads(None, RDTSegment.MAX_PAYLOAD_LEN)
+        self._outgoing.on_drained = self._on_drained
+        self._sender: Optional[asyncio.Task] = None
+        self._drained: Optional[asyncio.Future] = None  # waited for by send()
+        self._received = _Mailbox()  # chunks taken from the receiver, then b'' for the FIN of the peer
+        self._pending = b''  # the rest of a chunk after recv()
+        self._chunks = 0  # received
+        self.unread = 0  # bytes received and not yet taken by recv(), by which the window advertised shrinks
+        self.awaiting_acks = False  # while data or the FIN sent are, or else the ACKs of the peer are dropped
+        self._closed = False
+        self._receiving = asyncio.ensure_future(self._receive())
+
+    def send(self, data: Sendable):
+        """Send data, returning once they are all sent, though not necessarily acknowledged yet"""
+        self.socket._run(self.asend(data))
+
+    def recv(self, buffer_size: int) -> bytes:
+        """Receive up to buffer_size bytes, or b'' once the peer closes the connection"""
+        return self.socket._run(self.arecv(buffer_size))
+
+    def close(self):
+        self.socket._run(self.aclose())
+
+    async def asend(self, data: Sendable):
+        """Coroutine version of send()"""
+        if self._closed:
+            raise RuntimeError('connection closed')
+        if self._drained is not None:
+            raise RuntimeError('already sending')
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            chunks = [data]
+        elif hasattr(data, 'read'):  # a window at a time
+            chunks = iter(lambda: data.read(self.socket.win_size * RDTSegment.MAX_PAYLOAD_LEN), b'')
+        else:
+            chunks = data
+        for chunk in chunks:
+            if self._sender is not None and self._sender.done() and self._sender.exception() is not None:
+                raise self._sender.exception()
+            self._outgoing.push(chunk)
+            if self._sender is None or self._sender.done():
+                self._sender = asyncio.ensure_future(self._send())
+                self._sender.add_done_callback(self._on_sender_done)
+            else:
+                self._acks.put(None)  # the sender may be waiting for ACKs
+            if self._outgoing.queued:
+                self._drained = asyncio.get_running_loop().create_future()
+                try:
+                    await self._drained
+                finally:
+                    self._drained = None
+
+    async def arecv(self, buffer_size: int) -> bytes:
+        """Coroutine version of recv(), taking as many chunks as have arrived"""
+        data = bytearray(self._pending or await self._received.get())
+        while len(data) < buffer_size and self._received and self._received.peek():
+            data += await self._received.get()  # without waiting
+        if not data:  # FIN, to be seen by later calls as well
+            self._received.put(b'')
+        self._pending = bytes(data[buffer_size:])
+        self.unread -= len(data) - len(self._pending)
+        self.socket._update_window(self.peer)
+        return bytes(data[:buffer_size])
+
+    async def aclose(self, finish: bool=True):
+        """
+        Coroutine version of close(): send a FIN once all data sent are acknowledged, and then wait for
+        the FIN of the peer, unless nothing is heard from it for socket.IDLE_TIMEOUT seconds
+        """
+        if self._closed:
+            return
+        self._closed = True
+        sock = self.socket
+        try:
+            if finish:
+                with sock._watched():
+                    if self._sender is not None:
+                        await asyncio.gather(self._sender, return_exceptions=True)
+                    if self._sender is None or self._sender.exception() is None:
+                        self._acks.clear()
+                        self.awaiting_acks = True
+                        await sock._finish(self._outgoing.first, self.peer, self._acks)
+                        self.awaiting_acks = False
+                    while not self._receiving.done():
+                        chunks = self._chunks
+                        await asyncio.wait([self._receiving], timeout=socket.IDLE_TIMEOUT)
+                        if self._chunks == chunks:  # nothing heard from the peer
+                            break
+        finally:
+            for task in (self._sender, self._receiving):
+                if task is not None:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+            sock._flush_ack(self.peer)
+            del sock._senders[self.peer]
+            del sock._connections[self.peer]
+            del sock._last_acks[self.peer]
+            if sock._connection is self:
+                sock._connection = None
+
+    async def _send(self):
+        self._acks.clear()  # late duplicates, which would be taken for ACKs of the data to send
+        self.awaiting_acks = True
+        try:
+            with self.socket._watched():
+                await self.socket._send(self._outgoing, self.peer, self._acks)
+        finally:
+            self.awaiting_acks = False
+
+    def _on_drained(self):
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+
+    def _on_sender_done(self, sender: asyncio.Task):
+        if self._drained is not None and not self._drained.done() and not sender.cancelled():
+            if sender.exception() is not None:
+                self._drained.set_exception(sender.exception())
+
+    async def _receive(self):
+        with self.socket._watched():
+            async for payload in self.socket._stream(self.peer, idle_timeout=None):
+                self.socket.bytes_copied += len(payload)
+                self._received.put(bytes(payload))
+                self.unread += len(payload)
+                self._chunks += 1
+        self._received.put(b'')
+
+
+class _BufferPool:
+    """Buffers of the same size, recycled instead of allocated for every datagram received"""
+
+    def __init__(self, buffer_size: int, capacity: int):
+        self.buffer_size = buffer_size
+        self.capacity = capacity  # of buffers kept for reuse
+        self._free = []
+        self._shares: Dict[int, int] = {}  # id of a buffer -> releases to come before it is reused, beyond the first
+
+    def acquire(self) -> bytearray:
+        return self._free.pop() if self._free else bytearray(self.buffer_size)
+
+    def share(self, buffer: bytearray):
+        """Have a buffer released once more before it is reused, for one more holder to refer to its content"""
+        self._shares[id(buffer)] = self._shares.get(id(buffer), 0) + 1
+
+    def release(self, buffer: bytearray):
+        """Give a buffer back, once nothing refers to its content any more"""
+        shares = self._shares.pop(id(buffer), 0)
+        if shares > 1:
+            self._shares[id(buffer)] = shares - 1
+        elif not shares and len(self._free) < self.capacity:
+            self._free.append(buffer)
 
-    def accept(self):
-        raise NotImplementedError
 
-    def connect(self, address):
-        raise NotImplementedError
+class _Payloads:
+    """
+    Payloads of the segments to send, from bytes-like data, a binary file object or an iterable of bytes-like chunks
+
+    Bytes-like data are sliced by memoryview. Files and iterables are read as the window slides over them,
+    with their segments dropped once acknowledged, and chunks not of the payload size joined or split.
+    Without data, the payloads are those of the chunks push()ed, one after another, never coming to an end.
+
+    Segments are indexed from `first`, which is where the data start in the sequence number space, and which
+    follows the payloads released for those pushed, for a sender to go on from.
+    """
+
+    def __init__(self, data: Optional[Sendable], unit: int, first: int=0):
+        self.unit = unit
+        self.first = first
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self._view: Optional[memoryview] = memoryview(data).cast('B')
+            self.end: Optional[int] = first + -(-len(self._view) // unit)  # ceiling division
+            return
+        self._view = None
+        self.end = None  # until the end of the data is read
+        if data is None:
+            self._chunks: Optional[Iterator[bytes]] = None
+            self._queue: deque = deque()  # of chunks pushed
+            self.queued = 0  # bytes pushed and not yet read
+            self.on_drained: Optional[Callable[[], None]] = None  # once all those pushed are read
+        else:
+            self._chunks = iter(lambda: data.read(unit), b'') if hasattr(data, 'read') else iter(data)
+        self._pending = bytearray()  # read but not yet made into a payload
+        self._payloads: Dict[int, bytes] = {}  # index -> payload, for those read and not released
+        self._read = first  # index of the next payload to read
+        self._released = first  # index of the first payload not released, all before which are
+
+    def push(self, chunk: Union[bytes, bytearray, memoryview]):
+        self._queue.append(bytes(chunk))
+        self.queued += len(chunk)
+
+    def has(self, index: int) -> bool:
+        """Whether there is the index-th segment, which is read if not yet"""
+        while self.end is None and self._read <= index and self._read_payload():
+            pass
+        return index < (self.end if self.end is not None else self._read)
+
+    def get(self, index: int) -> Union[bytes, memoryview]:
+        if self._view is not None:
+            offset = (index - self.first) * self.unit
+            return self._view[offset:offset+self.unit]
+        return self._payloads[index]
+
+    def release(self, end: int):
+        """Drop the payloads before the end-th, which are acknowledged"""
+        if self._view is None:
+            while self._released < end:
+                del self._payloads[self._released]
+                self._released += 1
+            if self._chunks is None:
+                self.first = end
+
+    def _read_payload(self) -> bool:
+        """Read the next payload, returning whether there is one"""
+        while len(self._pending) < self.unit:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            if not self._pending and len(chunk) == self.unit:  # as read from a buffered file
+                self._payloads[self._read] = chunk
+                self._read += 1
+                return True
+            self._pending += chunk
+        if self._pending:  # short of a full payload only at the end of what there is
+            self._payloads[self._read] = bytes(self._pending[:self.unit])
+            del self._pending[:self.unit]
+            self._read += 1
+            return True
+        if self._chunks is not None:
+            self.end = self._read
+        return False
+
+    def _next_chunk(self) -> Optional[bytes]:
+        if self._chunks is not None:
+            return next(self._chunks, None)
+        if not self._queue:
+            return None
+        chunk = self._queue.popleft()
+        self.queued -= len(chunk)
+        if not self.queued and self.on_drained is not None:
+            self.on_drained()
+        return chunk
 
-    def recv(self, buffer_size: int):
-        raise NotImplementedError
 
-    def send(self, data: bytes):
-        raise NotImplementedError
+class _Mailbox:
+    """
+    Segments routed to a transfer (or other items), awaited with deadlines kept in the timer heap of the event loop
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._waiter: Optional[asyncio.Future] = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item):
+        self._items.append(item)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(True)
+
+    def peek(self):
+        return self._items[0]
+
+    def clear(self):
+        self._items.clear()
+
+    async def get(self, timeout: Optional[float]=None):
+        """Pop the earliest item, raising TimeoutException if nothing arrives within `timeout` seconds"""
+        if not self._items:
+            loop = asyncio.get_running_loop()
+            self._waiter = loop.create_future()
+            timer = loop.call_later(timeout, _Mailbox._expire, self._waiter) if timeout is not None else None
+            try:
+                if not await self._waiter:
+                    raise TimeoutException
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                self._waiter = None
+        return self._items.popleft()
+
+    @staticmethod
+    def _expire(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(False)
+
+
+class TransferStats:
+    """
+    Counters of the transfers of a socket
+
+    Segments received count those lost in the network emulation, and the corrupted ones count those which
+    fail to parse; duplicate ACKs are those which acknowledge nothing new. Goodput is the payload acknowledged
+    by peers and delivered from them per second of the time with any transfer in progress (or accept()).
+
+    RTT samples are counted in a histogram: rtt_histogram[i] is the number of those below RTT_BUCKETS[i]
+    (and not below the bucket before), with the last one for those of RTT_BUCKETS[-1] seconds and beyond.
+    """
+    RTT_BUCKETS = tuple(.0005 * 2 ** i for i in range(14))  # from 0.5 ms to 4 s
+
+    def __init__(self):
+        self.segments_sent = 0
+        self.bytes_sent = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.fast_retransmits = 0
+        self.segments_received = 0
+        self.corrupted = 0
+        self.duplicate_acks = 0
+        self.rebuilt = 0
+        self.bytes_acked = 0
+        self.bytes_delivered = 0
+        self.rtt_histogram = [0] * (len(TransferStats.RTT_BUCKETS) + 1)
+        self._busy_time = 0.
+        self._busy_since: Optional[float] = None
+
+    @property
+    def busy_time(self) -> float:
+        """Seconds with any transfer in progress"""
+        if self._busy_since is None:
+            return self._busy_time
+        return self._busy_time + monotonic() - self._busy_since
+
+    @property
+    def goodput(self) -> float:
+        """Bytes per second"""
+        busy_time = self.busy_time
+        return (self.bytes_acked + self.bytes_delivered) / busy_time if busy_time else 0.
+
+    def start_clock(self):
+        self._busy_since = monotonic()
+
+    def stop_clock(self):
+        self._busy_time = self.busy_time
+        self._busy_since = None
+
+    def record_rtt(self, rtt: float):
+        self.rtt_histogram[bisect_right(TransferStats.RTT_BUCKETS, rtt)] += 1
+
+    def rtt_percentile(self, percent: float) -> Optional[float]:
+        """Upper bound of the bucket of the RTT at the percentile, infinity if beyond, None if there is no sample"""
+        total = sum(self.rtt_histogram)
+        if not total:
+            return None
+        count = 0
+        for i, bucket_count in enumerate(self.rtt_histogram):
+            count += bucket_count
+            if count >= total * percent / 100:
+                return TransferStats.RTT_BUCKETS[i] if i < len(TransferStats.RTT_BUCKETS) else float('inf')
+
+    def as_dict(self) -> dict:
+        counters = {name: value for name, value in vars(self).items() if not name.startswith('_')}
+        counters.update(rtt_histogram=list(self.rtt_histogram), rtt_buckets=list(TransferStats.RTT_BUCKETS),
+                        busy_time=self.busy_time, goodput=self.goodput)
+        return counters
+
+    def summary(self) -> str:
+        if sum(self.rtt_histogram):
+            rtt = 'RTT p50 < {}, p99 < {}'.format(TransferStats._format_rtt(self.rtt_percentile(50)),
+                                                  TransferStats._format_rtt(self.rtt_percentile(99)))
+        else:
+            rtt = 'no RTT sample'
+        return ('sent {} segments ({} retransmitted, {} timeouts, {} fast retransmits), received {} ({} corrupted, '
+                '{} duplicate ACKs, {} rebuilt), {} bytes acked, {} bytes delivered, goodput {:.1f} KB/s, {}').format(
+            self.segments_sent, self.retransmits, self.timeouts, self.fast_retransmits, self.segments_received,
+            self.corrupted, self.duplicate_acks, self.rebuilt, self.bytes_acked, self.bytes_delivered,
+            self.goodput / 1024, rtt)
+
+    @staticmethod
+    def _format_rtt(rtt: float) -> str:
+        return '{:g} ms'.format(rtt * 1000) if rtt < float('inf') else 'inf'
+
+
+class RTTEstimator:
+    """
+    Retransmission Timeout Estimator (RFC 6298)
+
+    Feed it with the RTTs of segments that were never retransmitted (Karn's algorithm),
+    and call backoff() whenever the retransmission timer expires. Like Linux does, the backoff is
+    undone by reset_backoff() once new data are acknowledged, because under heavy loss the samples
+    that Karn's algorithm allows are too rare to bring a backed-off timeout back down.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    CLOCK_GRANULARITY = .001
+    MIN_RTO = .01  # far below the 1 s of RFC 6298, so that losses on a LAN are recovered quickly
+    MAX_RTO = 4.
+
+    def __init__(self, initial_rto: float):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.rto = initial_rto
+        self._unbacked_rto = initial_rto
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTTEstimator.BETA) * self.rttvar + RTTEstimator.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTTEstimator.ALPHA) * self.srtt + RTTEstimator.ALPHA * rtt
+        rto = self.srtt + max(RTTEstimator.CLOCK_GRANULARITY, RTTEstimator.K * self.rttvar)
+        self.rto = self._unbacked_rto = min(max(rto, RTTEstimator.MIN_RTO), RTTEstimator.MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, RTTEstimator.MAX_RTO)
+
+    def reset_backoff(self):
+        self.rto = self._unbacked_rto
+
+
+class _Path:
+    """
+    State of the transfers with a peer: the RTT estimate and the loss rate of FEC, kept from one to the next,
+    and the congestion window of the latest
+    """
+
+    def __init__(self, fec: bool):
+        self.rtt_estimator = RTTEstimator(socket.TIMEOUT)
+        self.congestion = CongestionController(max_window=socket.WIN_SIZE)
+        self.fec = FecController() if fec else None
+
+
+class CongestionController:
+    """
+    TCP-like Congestion Control (RFC 5681), with the window counted in segments
+
+    The window starts with slow start, growing by one segment per segment acknowledged until it reaches
+    the slow start threshold, and then grows by one segment per window (additive increase). A fast retransmit
+    triggered by duplicate ACKs halves it (multiplicative decrease), while a timeout restarts slow start.
+    """
+    INITIAL_WINDOW = 4
+    MIN_SSTHRESH = 2
+    DUP_ACK_THRESHOLD = 3
+
+    def __init__(self, max_window: int):
+        self.max_window = max_window
+        self.cwnd = float(CongestionController.INITIAL_WINDOW)
+        self.ssthresh = float(max_window)
+
+    @property
+    def window(self) -> int:
+        return int(self.cwnd)
+
+    def on_ack(self, acked: int):
+        """New data acknowledged, `acked` segments in total"""
+        for _ in range(acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_fast_retransmit(self, in_flight: int):
+        self.ssthresh = max(in_flight / 2, CongestionController.MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight: int):
+        self.ssthresh = max(in_flight / 2, CongestionController.MIN_SSTHRESH)
+        self.cwnd = 1.
+
+
+class FecController:
+    """
+    Forward Error Correction, with a parity segment sent after every group of data segments
+
+    A parity segment is the XOR of the data segments of its group, from which the receiver rebuilds one of them
+    lost or corrupted without waiting for a retransmission (but not two). The size of the groups adapts to the loss
+    rate, a moving average over the segments sent, of the losses the sender learns about: timeouts, fast retransmits,
+    and ACKs arriving out of order, as those of the segments rebuilt do. Groups are sized for half a segment of
+    a group and its parity to be lost on average: down to MIN_GROUP (a copy of every segment) under heavy loss,
+    and up to MAX_GROUP when losses are rare.
+    """
+    MIN_GROUP = 1
+    MAX_GROUP = 32
+    INITIAL_LOSS_RATE = .05
+    GAIN = 1 / 64
+
+    def __init__(self):
+        self.loss_rate = FecController.INITIAL_LOSS_RATE
+
+    @property
+    def group_size(self) -> int:
+        if self.loss_rate * (FecController.MAX_GROUP + 1) <= .5:
+            return FecController.MAX_GROUP
+        return max(int(.5 / self.loss_rate) - 1, FecController.MIN_GROUP)
+
+    def on_delivered(self, acked: int):
+        """`acked` segments acknowledged"""
+        self.loss_rate *= (1 - FecController.GAIN) ** acked
+
+    def on_loss(self):
+        self.loss_rate += FecController.GAIN * (1 - self.loss_rate)
+
+
+class _ParityEncoder:
+    """Parity of the groups of data segments sent for the first time, with payloads XORed as big integers"""
+
+    def __init__(self, fec: FecController, first: int):
+        self.fec = fec
+        self.group_size = fec.group_size  # of the current group
+        self._start = first  # index of the first segment of the current group
+        self._count = 0  # segments in the current group so far
+        self._xor = 0  # of the payloads padded with zeros to MAX_PAYLOAD_LEN
+        self._length_xor = 0
+        self._max_length = 0
+
+    def add(self, index: int, payload: Union[bytes, memoryview]) -> Optional['RDTSegment']:
+        """Add the next segment, returning the parity segment if it completes the group"""
+        assert index == self._start + self._count
+        length = len(payload) if payload else 0
+        if length:
+            self._xor ^= int.from_bytes(payload, 'big') << (8 * (RDTSegment.MAX_PAYLOAD_LEN - length))
+        self._length_xor ^= length
+        self._max_length = max(self._max_length, length)
+        self._count += 1
+        return self.flush() if self._count >= self.group_size else None
+
+    def flush(self) -> Optional['RDTSegment']:
+        """Parity segment of the current group, complete or not, if there are segments in it"""
+        if not self._count:
+            return None
+        padding = RDTSegment.MAX_PAYLOAD_LEN - self._max_length
+        payload = (self._xor >> (8 * padding)).to_bytes(self._max_length, 'big')
+        parity = RDTSegment(payload, seq_num=self._start, ack_num=self._length_xor, window=self._count, parity=True)
+        self._start += self._count
+        self._count = self._xor = self._length_xor = self._max_length = 0
+        self.group_size = self.fec.group_size
+        return parity
+
+
+class _ParityDecoder:
+    """
+    Payloads received from a peer, with which a segment missing from a group is rebuilt
+
+    The payloads are not copied: the buffers they are read into are shared with the receiver, and released
+    once their group is decoded, or once they are too old for their parity to be on the way.
+    """
+    CAPACITY = 4 * FecController.MAX_GROUP
+
+    def __init__(self, buffers: _BufferPool):
+        self._buffers = buffers
+        # sequence number -> payload and its buffer, of segments not covered by parity yet
+        self._payloads: Dict[int, Tuple[memoryview, bytearray]] = {}
+
+    def add(self, segment: 'RDTSegment', buffer: bytearray):
+        self._buffers.share(buffer)
+        self._release(self._payloads.pop(segment.seq_num, None))  # the one retransmitted
+        self._payloads[segment.seq_num] = (segment.payload, buffer)
+        if len(self._payloads) > _ParityDecoder.CAPACITY:  # segments of groups whose parity is lost
+            self._release(self._payloads.pop(next(iter(self._payloads))))
+
+    def clear(self):
+        for entry in self._payloads.values():
+            self._release(entry)
+        self._payloads.clear()
+
+    def _release(self, entry: Optional[Tuple[memoryview, bytearray]]):
+        if entry is not None:
+            self._buffers.release(entry[1])
+
+    def recover(self, parity: 'RDTSegment') -> List[Tuple[int, bytes]]:
+        """
+        Rebuild the segment missing from the group of a parity segment, if only one is
+
+        :return: sequence numbers and payloads of the segment rebuilt and those received after it in the group
+                 (which a Go-Back-N receiver has discarded), nothing if there is no segment to rebuild
+        """
+        bound = RDTSegment.SEQ_NUM_BOUNDS[parity.version]
+        group = [(parity.seq_num + i) % bound for i in range(parity.window)]
+        entries = [self._payloads.pop(seq_num, None) for seq_num in group]
+        try:
+            return self._recover(parity, group, [entry and entry[0] for entry in entries])
+        finally:
+            for entry in entries:
+                self._release(entry)
+
+    @staticmethod
+    def _recover(parity: 'RDTSegment', group: List[int], received: List[Optional[memoryview]]) \
+            -> List[Tuple[int, bytes]]:
+        if received.count(None) != 1:
+            return []
+        missing = received.index(None)
+        max_length = RDTSegment.MAX_PAYLOAD_LEN
+        xor = int.from_bytes(parity.payload, 'big') << (8 * (max_length - len(parity.payload)))
+        length = parity.ack_num
+        for payload in received:
+            if payload:
+                xor ^= int.from_bytes(payload, 'big') << (8 * (max_length - len(payload)))
+                length ^= len(payload)
+        # bytes beyond the length tell parity inconsistent with the segments, one of which got through corrupted
+        if length > max_length or xor & ((1 << (8 * (max_length - length))) - 1):
+            return []
+        received[missing] = (xor >> (8 * (max_length - length))).to_bytes(length, 'big')
+        return [(seq_num, bytes(payload)) for seq_num, payload in zip(group[missing:], received[missing:])]
 
 
 class RDTSegment:
@@ -203,93 +1801,178 @@ class RDTSegment:
     +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
     |                           CHECKSUM                            |
     +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                            WINDOW                             |  (since version 2)
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                                                               |
+    /                            PAYLOAD                            /
+    /                                                               /
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+
+    Segment Format of Version 3, with 32-bit sequence numbers (and CHECKSUM kept at the same offset):
+
+      0   1   2   3   4   5   6   7   8   9   a   b   c   d   e   f
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |VERSION|SYN|FIN|ACK|                  LENGTH                   |
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                            WINDOW                             |
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                           CHECKSUM                            |
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                             SEQ #                             |
+    +                                                               +
+    |                                                               |
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+    |                             ACK #                             |
+    +                                                               +
+    |                                                               |
+    +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
     |                                                               |
     /                            PAYLOAD                            /
     /                                                               /
     +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
 
-    Protocol Version:           1
+    Protocol Version:           3  (segments of versions 1 and 2 are still understood)
+
+    Segment Length:             header and LENGTH bytes of payload, anything after which is ignored
+                                (version 1: fixed, with the payload padded with zeros to 1440 bytes)
 
     Flags:
      - SYN                      Synchronize
      - FIN                      Finish
      - ACK                      Acknowledge
+     - SYN and FIN together     Parity (since version 3): the XOR of the payloads, padded with zeros, of WINDOW data
+                                segments from SEQ # on, with ACK # the XOR of their lengths (see FecController)
 
     Ranges:
-     - Payload Length           0 - 1440  (append zeros to the end if length < 1440)
-     - Sequence Number          0 - 255
-     - Acknowledgement Number   0 - 255
+     - Payload Length           0 - 1440
+     - Sequence Number          0 - 255 (version 3: 0 - 4294967295)
+     - Acknowledgement Number   0 - 255 (version 3: 0 - 4294967295)
+     - Window                   0 - 65535 (segments the sender of this segment is able to receive)
 
     Checksum Algorithm:         16 bit one's complement of the one's complement sum
 
-    Size of sender's window     16
+    Size of sender's window     min(congestion window, receiver's window)
     """
 
-    HEADER_LEN = 6
+    VERSION = 3
+    HEADER_FORMATS = {1: struct.Struct('!HBBH'), 2: struct.Struct('!HBBHH'), 3: struct.Struct('!HHHII')}
+    HEADER_LEN = HEADER_FORMATS[VERSION].size
     MAX_PAYLOAD_LEN = 1440
-    SEGMENT_LEN = MAX_PAYLOAD_LEN + HEADER_LEN
-    SEQ_NUM_BOUND = 256
+    SEGMENT_LEN = MAX_PAYLOAD_LEN + HEADER_LEN  # the longest among all versions
+    SEQ_NUM_BOUNDS = {1: 256, 2: 256, 3: 2 ** 32}
+    MAX_WINDOW = 0xFFFF
+    _PADDING = memoryview(bytes(MAX_PAYLOAD_LEN))
 
-    def __init__(self, payload: bytes, seq_num: int, ack_num: int, syn: bool=False, fin: bool=False, ack: bool=False):
+    def __init__(self, payload: bytes, seq_num: int, ack_num: int, syn: bool=False, fin: bool=False, ack: bool=False,
+                 window: Optional[int]=0, version: int=VERSION, parity: bool=False):
         self.syn = syn
         self.fin = fin
         self.ack = ack
-        self.seq_num = seq_num % RDTSegment.SEQ_NUM_BOUND
-        self.ack_num = ack_num % RDTSegment.SEQ_NUM_BOUND
+        self.parity = parity
+        self.seq_num = seq_num % RDTSegment.SEQ_NUM_BOUNDS[version]
+        self.ack_num = ack_num % RDTSegment.SEQ_NUM_BOUNDS[version]
         if payload is not None and len(payload) > RDTSegment.MAX_PAYLOAD_LEN:
             raise ValueError
         self.payload = payload
+        self.window = window  # None if unknown (version 1)
+        self.version = version
+
+    def encoded_len(self) -> int:
+        """Length of the segment encoded, padding included"""
+        if self.version == 1:
+            return RDTSegment.HEADER_FORMATS[1].size + RDTSegment.MAX_PAYLOAD_LEN
+        return RDTSegment.HEADER_FORMATS[self.version].size + (len(self.payload) if self.payload else 0)
 
     def encode(self) -> bytes:
-        """Returns fixed length bytes"""
-        head = 0x4000 | (len(self.payload) if self.payload else 0)  # protocol version: 1
+        """Returns the bytes of the segment, padded to the fixed length for version 1"""
+        arr = bytearray(RDTSegment.SEGMENT_LEN)
+        length = self.encode_into(arr)
+        return bytes(memoryview(arr)[:length])
+
+    def encode_into(self, buffer: Union[bytearray, memoryview], offset: int=0) -> int:
+        """
+        Encode into a preallocated buffer, copying nothing but the payload (and the padding of version 1)
+
+        :return: the length of the segment
+        """
+        header_format = RDTSegment.HEADER_FORMATS[self.version]
+        length = len(self.payload) if self.payload else 0
+        head = (self.version << 14) | length
         if self.syn:
             head |= 0x2000
         if self.fin:
             head |= 0x1000
         if self.ack:
             head |= 0x0800
-        arr = bytearray(struct.pack('!HBBH', head, self.seq_num, self.ack_num, 0))
-        if self.payload:
-            arr.extend(self.payload)
-        checksum = RDTSegment.calc_checksum(arr)
-        arr[4] = checksum >> 8
-        arr[5] = checksum & 0xFF
-        arr.extend(b'\x00' * (RDTSegment.SEGMENT_LEN - len(arr)))  # so that the total length is fixed
-        return bytes(arr)
+        if self.parity:
+            head |= 0x3000
+        window = min(self.window or 0, RDTSegment.MAX_WINDOW)
+        if self.version == 1:
+            header_format.pack_into(buffer, offset, head, self.seq_num, self.ack_num, 0)
+        elif self.version == 2:
+            header_format.pack_into(buffer, offset, head, self.seq_num, self.ack_num, 0, window)
+        else:
+            header_format.pack_into(buffer, offset, head, window, 0, self.seq_num, self.ack_num)
+        start = offset + header_format.size
+        end = start + length
+        if length:
+            buffer[start:end] = self.payload
+        if self.version == 1:  # of fixed length
+            buffer[end:start+RDTSegment.MAX_PAYLOAD_LEN] = RDTSegment._PADDING[length:]
+            end = start + RDTSegment.MAX_PAYLOAD_LEN
+        checksum = RDTSegment.calc_checksum(memoryview(buffer)[offset:end])
+        struct.pack_into('!H', buffer, offset + 4, checksum)
+        return end - offset
 
     @staticmethod
-    def parse(segment: Union[bytes, bytearray]) -> 'RDTSegment':
-        """Parse raw bytes into an RDTSegment object"""
+    def parse(segment: Union[bytes, bytearray, memoryview]) -> 'RDTSegment':
+        """Parse raw bytes into an RDTSegment object, whose payload is a slice (a view for memoryview) of them"""
         try:
-            assert len(segment) == RDTSegment.SEGMENT_LEN
-            # assert 0 <= len(segment) - 6 <= RDTSegment.MAX_PAYLOAD_LEN
-            assert RDTSegment.calc_checksum(segment) == 0
-            head, = struct.unpack('!H', segment[0:2])
+            assert len(segment) >= 2
+            head, = struct.unpack_from('!H', segment)
             version = (head & 0xC000) >> 14
-            assert version == 1
+            assert version in RDTSegment.HEADER_FORMATS
+            header_format = RDTSegment.HEADER_FORMATS[version]
+            length = head & 0x07FF
+            assert length <= RDTSegment.MAX_PAYLOAD_LEN
+            if version == 1:
+                assert len(segment) == header_format.size + RDTSegment.MAX_PAYLOAD_LEN
+                assert RDTSegment.calc_checksum(segment) == 0
+            else:
+                assert len(segment) >= header_format.size + length
+                assert RDTSegment.calc_checksum(memoryview(segment)[:header_format.size+length]) == 0
             syn = (head & 0x2000) != 0
             fin = (head & 0x1000) != 0
             ack = (head & 0x0800) != 0
-            length = head & 0x07FF
-            # assert length + 6 == len(segment)
-            seq_num, ack_num, checksum = struct.unpack('!BBH', segment[2:6])
-            payload = segment[6:6+length]
-            return RDTSegment(payload, seq_num, ack_num, syn, fin, ack)
+            parity = syn and fin
+            if parity:
+                syn = fin = False
+            if version == 1:
+                _, seq_num, ack_num, checksum = header_format.unpack_from(segment)
+                window = None
+            elif version == 2:
+                _, seq_num, ack_num, checksum, window = header_format.unpack_from(segment)
+            else:
+                _, window, checksum, seq_num, ack_num = header_format.unpack_from(segment)
+            payload = segment[header_format.size:header_format.size+length]
+            return RDTSegment(payload, seq_num, ack_num, syn, fin, ack, window, version, parity)
         except AssertionError as e:
             raise ValueError from e
 
     @staticmethod
-    def calc_checksum(segment: Union[bytes, bytearray]) -> int:
+    def calc_checksum(segment: Union[bytes, bytearray, memoryview]) -> int:
         """
         :param segment: raw bytes of a segment, with its checksum set to 0
         :return: 16-bit unsigned checksum
         """
-        i = iter(segment)
-        bytes_sum = sum(((a << 8) + b for a, b in zip(i, i)))  # for a, b: (s[0], s[1]), (s[2], s[3]), ...
+        # Read as one big-endian integer, the segment is sum(word * 0x10000 ** k), and as 0x10000 % 0xFFFF == 1,
+        # it is congruent to the sum of its 16-bit words modulo 0xFFFF, which is what adding the overflow at the end
+        # computes, save that the one's complement sum of nonzero words is 0xFFFF rather than 0.
+        # The big integer is built and reduced in C, instead of a Python loop over the words.
+        words = int.from_bytes(segment, 'big')
         if len(segment) % 2 == 1:  # pad zeros to form a 16-bit word for checksum
-            bytes_sum += segment[-1] << 8
-        # add the overflow at the end (adding twice is sufficient)
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
-        bytes_sum = (bytes_sum & 0xFFFF) + (bytes_sum >> 16)
+            words <<= 8
+        bytes_sum = words % 0xFFFF
+        if bytes_sum == 0 and words != 0:
+            bytes_sum = 0xFFFF
         return ~bytes_sum & 0xFFFF
@@ -1,23 +1,47 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
-from rdt import socket
+from rdt import Connection, socket
 
 
 SERVER_ADDR = '127.0.0.1'
 SERVER_PORT = 9999
+BUFFER_SIZE = 65536
+STATS_INTERVAL = 10
 
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO, format='[SERVER %(levelname)s] %(asctime)s: %(message)s')
+async def main():
     server = socket()
     server.bind((SERVER_ADDR, SERVER_PORT))
-    while True:
+    server.stats_interval = STATS_INTERVAL
+    server.listen()
+
+    async def echo(connection: Connection, client_addr: tuple):
+        # echoing what has arrived while the rest is on the way, with the ACKs of the former piggybacked
         try:
-            data, client_addr = server.recvfrom()
-            server.sendto(data, client_addr)
+            while True:
+                data = await connection.arecv(BUFFER_SIZE)
+                if not data:
+                    break
+                await connection.asend(data)
         except ConnectionError:
-            logging.exception('Connection aborted by the client')
-        except KeyboardInterrupt:
-            logging.info('Quit.')
-            break
+            logging.exception('Connection with %s:%d aborted', *client_addr)
+        finally:
+            await connection.aclose()
+
+    # clients are served at a time, each through a connection of its own
+    echoes = set()
+    while True:
+        connection, client_addr = await server.aaccept()
+        task = asyncio.ensure_future(echo(connection, client_addr))
+        echoes.add(task)
+        task.add_done_callback(echoes.discard)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[SERVER %(levelname)s] %(asctime)s: %(message)s')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info('Quit.')
@@ -1,34 +1,129 @@
 from socket import *
-import random, time
+import heapq, itertools, json, random, select, time
 
 
 class UDPsocket(socket):
-    def __init__(self, loss_rate=0.1, corruption_rate=0.3, delay_rate=0.1, delay=0.5):
+    """
+    UDP socket emulating an unreliable network on receipt
+
+    - loss_rate: probability that a datagram is lost, in the good state of the channel if burst_rate is set,
+      in which case the channel is a Gilbert-Elliott one: it turns bad with probability burst_rate for every
+      datagram, stays bad for burst_length datagrams on average, and loses them with burst_loss_rate meanwhile
+    - corruption_rate: probability that up to 3 bytes of a datagram are overwritten
+    - delay_rate, delay: probability that a datagram is delayed by `delay` seconds, on top of a random jitter
+      of up to `jitter` seconds; datagrams delayed are overtaken by the others rather than holding them up
+    - bandwidth: bytes per second of a bottleneck link, through which datagrams go one after another,
+      queued up to queue_limit bytes (unlimited if None) and dropped beyond
+    - seed: of the random number generator of the socket, so that the fates of the datagrams received
+      are the same in every run (as long as the datagrams are)
+    - replay: trace recorded by a socket with `record=True` (see save_trace()), or the path of a file saved,
+      whose fates are met again in order, with the random ones back once it is over; the bottleneck link,
+      which is deterministic, is emulated live either way
+    """
+
+    def __init__(self, loss_rate=0.1, corruption_rate=0.3, delay_rate=0.1, delay=0.5, jitter=0.,
+                 burst_rate=0., burst_length=5., burst_loss_rate=1., bandwidth=None, queue_limit=None,
+                 seed=None, record=False, replay=None):
         super().__init__(AF_INET, SOCK_DGRAM)
         self.loss_rate = loss_rate
         self.corruption_rate = corruption_rate
         self.delay_rate = delay_rate
         self.delay = delay
+        self.jitter = jitter
+        self.burst_rate = burst_rate
+        self.burst_length = burst_length
+        self.burst_loss_rate = burst_loss_rate
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed)
+        self.trace = [] if record else None  # fates of the datagrams received: (lost, delay, [(position, byte)])
+        if isinstance(replay, str):
+            with open(replay) as f:
+                replay = json.load(f)
+        self._replay = iter(replay) if replay is not None else None
+        self._bad = False  # state of the Gilbert-Elliott channel
+        self._link_free_at = 0.  # when the bottleneck link is done with the datagrams before
+        self._delayed = []  # heap of (when due, arrival, data, address), for recvfrom()
+        self._arrivals = itertools.count()
 
     def recvfrom(self, bufsize):
-        data, addr = super().recvfrom(bufsize)
-        if random.random() < self.loss_rate:
-            # return self.recvfrom(bufsize)
-            return super(type(self), self).recvfrom(bufsize)
-        if random.random() < self.delay_rate:
-            time.sleep(self.delay)
-        if random.random() < self.corruption_rate:
-            return self._corrupt(data), addr
-        return data, addr
+        """Receive the next datagram due, with those delayed held back meanwhile"""
+        while True:
+            if self._delayed:
+                timeout = self._delayed[0][0] - time.monotonic()
+                if timeout <= 0:
+                    _, _, data, addr = heapq.heappop(self._delayed)
+                    return data, addr
+                if self.gettimeout() != 0 and not select.select([self], [], [], timeout)[0]:
+                    continue
+            data, addr = super().recvfrom(bufsize)
+            data, delay = self._emulate(data)
+            if data is None:
+                continue
+            if not delay and not self._delayed:
+                return data, addr
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._arrivals), data, addr))
 
     def recv(self, bufsize):
         data, addr = self.recvfrom(bufsize)
         return data
 
-    def _corrupt(self, data: bytes) -> bytes:
-        # raw = list(data)
+    def save_trace(self, file):
+        """Save the trace recorded to a path or a text file object, for sockets to replay"""
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                json.dump(self.trace, f)
+        else:
+            json.dump(self.trace, file)
+
+    def _emulate(self, data: bytes):
+        """
+        Decide the fate of a received datagram, without blocking
+
+        :return: the datagram (corrupted or not), or None if it is lost, and the seconds to delay it
+        """
+        lost, delay, corruption = self._fate(len(data))
+        if self.bandwidth:
+            now = time.monotonic()
+            start = max(now, self._link_free_at)
+            if self.queue_limit is not None and (start - now) * self.bandwidth > self.queue_limit:
+                return None, 0  # the queue is full
+            self._link_free_at = start + len(data) / self.bandwidth
+            delay += self._link_free_at - now
+        if lost:
+            return None, 0
+        if corruption:
+            data = self._corrupt(data, corruption)
+        return data, delay
+
+    def _fate(self, length: int):
+        """Whether a datagram is lost, how long it is delayed, and how it is corrupted, recorded if asked to"""
+        fate = next(self._replay, None) if self._replay is not None else None
+        if fate is None:
+            # as many calls to random() for every datagram, whatever its fate and length, for the fates of the next
+            # to be the same (randrange() and randint() would take a number of random bits depending on their range)
+            rand = self.random
+            if self.burst_rate:
+                if self._bad:
+                    self._bad = rand.random() >= 1 / self.burst_length
+                else:
+                    self._bad = rand.random() < self.burst_rate
+            lost = rand.random() < (self.burst_loss_rate if self._bad else self.loss_rate)
+            delay = self.delay if rand.random() < self.delay_rate else 0
+            if self.jitter:
+                delay += rand.uniform(0, self.jitter)
+            corrupted = rand.random() < self.corruption_rate
+            count = int(rand.random() * 4)  # of bytes overwritten, up to 3
+            corruption = [(int(rand.random() * length), int(rand.random() * 256)) for _ in range(3)][:count]
+            fate = (lost, delay, corruption if corrupted else [])
+        if self.trace is not None:
+            self.trace.append(fate)
+        return fate
+
+    @staticmethod
+    def _corrupt(data: bytes, corruption) -> bytes:
         raw = bytearray(data)
-        for i in range(0, random.randint(0, 3)):
-            pos = random.randint(0, len(raw) - 1)
-            raw[pos] = random.randint(0, 255)
+        for pos, byte in corruption:
+            if raw:
+                raw[pos % len(raw)] = byte
         return bytes(raw)